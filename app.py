@@ -1,9 +1,23 @@
+import abc
 import os
 import json
+import base64
+import contextvars
 import datetime
+import hmac
+import math
+import queue
+import random
 import re
-import requests
-from flask import Flask, request
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, wraps
+from zoneinfo import ZoneInfo
+import click
+from flask import Flask, Response, request, stream_with_context
 
 # ================================
 # CONFIG
@@ -23,7 +37,23 @@ AI_MODEL = os.environ.get(
     "HuggingFaceTB/SmolLM3-3B:hf-inference",
 )
 
-TELEGRAM_API = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
+# Модель для фото еды; по умолчанию тот же OpenAI-совместимый эндпоинт и ключ
+AI_VISION_ENDPOINT = os.environ.get("AI_VISION_ENDPOINT", AI_ENDPOINT)
+AI_VISION_KEY = os.environ.get("AI_VISION_KEY", AI_KEY)
+AI_VISION_MODEL = os.environ.get("AI_VISION_MODEL")
+
+SUPABASE_SCHEMA = os.environ.get("SUPABASE_SCHEMA")
+# Секрет из setWebhook(secret_token=...), Telegram присылает его в заголовке
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# JSON-список дополнительных ботов (см. Tenant.from_config)
+TENANTS_FILE = os.environ.get("TENANTS_FILE")
+
+# Зона для пользователей без своего часового пояса в профиле
+DEFAULT_TZ = os.environ.get("DEFAULT_TZ", "UTC")
+
+# lazy — всё строится по требованию (как раньше);
+# eager — конфиг проверяется при загрузке, соединения прогреваются в фоне
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "lazy")
 
 app = Flask(__name__)
 
@@ -31,70 +61,816 @@ app = Flask(__name__)
 MEAL_KCAL_CAP = 1500
 
 
+# ================================
+# TENANTS
+# ================================
+
+
+class Tenant:
+    """
+    Один бот (бренд) в общем процессе: свой токен Telegram, своя база/схема Supabase,
+    своя модель и правки текстов. Пулы соединений, модели и кэши — общие,
+    но данные в кэшах разделены по tenant.id.
+    """
+
+    def __init__(self, tenant_id, telegram_token, supabase_url, supabase_key,
+                 supabase_schema=None, ai_model=None, texts=None, webhook_secret=None):
+        self.id = tenant_id
+        self.telegram_token = telegram_token
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
+        self.supabase_schema = supabase_schema
+        self.ai_model = ai_model or AI_MODEL
+        self.texts = texts or {}
+        self.webhook_secret = webhook_secret
+        self.telegram_api = f"https://api.telegram.org/bot{telegram_token}"
+        self.telegram_file_api = f"https://api.telegram.org/file/bot{telegram_token}"
+        self._merged_texts = {}
+
+    @classmethod
+    def from_config(cls, cfg):
+        """
+        {"id", "telegram_token", "supabase_url"?, "supabase_key"?, "supabase_schema"?,
+         "ai_model"?, "texts"?: {"ru": {...}}, "webhook_secret"?}
+        Не указанное берётся из основного конфига, но данные должны быть свои:
+        отдельный supabase_url или отдельная supabase_schema — иначе арендатор читал бы
+        и писал профили основного бота.
+        """
+        tenant_id = cfg.get("id")
+        if not tenant_id or tenant_id == "default":
+            raise RuntimeError(f"Tenant config: id must be set and not 'default': {tenant_id!r}")
+        url = cfg.get("supabase_url")
+        schema = cfg.get("supabase_schema")
+        if (not url or url == SUPABASE_URL) and (not schema or schema == SUPABASE_SCHEMA):
+            raise RuntimeError(f"Tenant config {tenant_id}: own supabase_url or supabase_schema required")
+        return cls(
+            tenant_id,
+            cfg["telegram_token"],
+            url or SUPABASE_URL,
+            cfg.get("supabase_key") or SUPABASE_KEY,
+            supabase_schema=schema,
+            ai_model=cfg.get("ai_model"),
+            texts=cfg.get("texts"),
+            webhook_secret=cfg.get("webhook_secret"),
+        )
+
+
+def load_tenants():
+    tenants = {
+        "default": Tenant("default", TELEGRAM_TOKEN, SUPABASE_URL, SUPABASE_KEY,
+                          supabase_schema=SUPABASE_SCHEMA, webhook_secret=WEBHOOK_SECRET),
+    }
+    stores = {(SUPABASE_URL, SUPABASE_SCHEMA): "default"}
+    if TENANTS_FILE:
+        with open(TENANTS_FILE, encoding="utf-8") as f:
+            for cfg in json.load(f):
+                tenant = Tenant.from_config(cfg)
+                if tenant.id in tenants:
+                    raise RuntimeError(f"Tenant config: duplicate id {tenant.id}")
+                store = (tenant.supabase_url, tenant.supabase_schema)
+                if store in stores:
+                    raise RuntimeError(f"Tenant config {tenant.id}: same Supabase data as {stores[store]}")
+                stores[store] = tenant.id
+                tenants[tenant.id] = tenant
+    return tenants
+
+
+TENANTS = load_tenants()
+DEFAULT_TENANT = TENANTS["default"]
+
+_current_tenant = contextvars.ContextVar("tenant", default=DEFAULT_TENANT)
+
+
+def current_tenant():
+    return _current_tenant.get()
+
+
+@contextmanager
+def tenant_context(tenant):
+    token = _current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current_tenant.reset(token)
+
+
+def tenant_key(user_id):
+    """
+    Ключ пользователя в общих локальных кэшах и хранилищах.
+    У основного бота — просто user_id, чтобы старые данные остались на месте.
+    """
+    tenant = current_tenant()
+    return str(user_id) if tenant is DEFAULT_TENANT else f"{tenant.id}:{user_id}"
+
+
+def submit_in_context(pool, fn, *args):
+    """
+    pool.submit с текущим контекстом (бот-арендатор): потоки пула его не наследуют.
+    """
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+# ================================
+# STARTUP / HTTP
+# ================================
+
+
+class LazyTable:
+    """
+    Словарь, значения которого строятся функциями при первом обращении.
+    Поддерживает то, что нужно коду: table[key], key in table, table.get(key, default).
+    """
+
+    def __init__(self, builders):
+        self._builders = builders
+        self._built = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._builders
+
+    def __getitem__(self, key):
+        value = self._built.get(key)
+        if value is not None:
+            return value
+        builder = self._builders[key]
+        with self._lock:
+            if key not in self._built:
+                self._built[key] = builder()
+            return self._built[key]
+
+    def get(self, key, default=None):
+        if key in self._builders:
+            return self[key]
+        return default
+
+    def keys(self):
+        return self._builders.keys()
+
+
+_http_session = None
+_http_lock = threading.Lock()
+
+
+def http():
+    """
+    Общая requests.Session: keep-alive и пул соединений к Supabase/Telegram/HF.
+    requests импортируется лениво, чтобы не тормозить холодный старт.
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_lock:
+            if _http_session is None:
+                import requests
+                _http_session = requests.Session()
+    return _http_session
+
+
+def missing_config():
+    required = {
+        "AI_ENDPOINT": AI_ENDPOINT,
+        "AI_KEY": AI_KEY,
+        "AI_MODEL": AI_MODEL,
+    }
+    for tenant in TENANTS.values():
+        prefix = "" if tenant is DEFAULT_TENANT else f"{tenant.id}."
+        required[prefix + "TELEGRAM_TOKEN"] = tenant.telegram_token
+        required[prefix + "SUPABASE_URL"] = tenant.supabase_url
+        required[prefix + "SUPABASE_ANON_KEY"] = tenant.supabase_key
+    return [name for name, value in required.items() if not value]
+
+
+def validate_config():
+    missing = missing_config()
+    if missing:
+        raise RuntimeError("Config missing: " + ", ".join(missing))
+
+
+def prewarm_connections():
+    """
+    Открываем TLS-соединения заранее, чтобы первый апдейт не платил за рукопожатия.
+    Ответы не важны — важно, что соединение осталось в пуле сессии.
+    """
+    urls = {"https://api.telegram.org/", AI_ENDPOINT}
+    urls.update(f"{t.supabase_url}/rest/v1/" for t in TENANTS.values())
+    for url in urls:
+        try:
+            http().head(url, timeout=5)
+        except Exception as e:
+            print("prewarm error:", url, e)
+
+
+def start_prewarm():
+    t = threading.Thread(target=prewarm_connections, name="prewarm", daemon=True)
+    t.start()
+    return t
+
+
+# ================================
+# METRICS
+# ================================
+
+
+class Metrics:
+    """
+    Простые счётчики и наблюдения (count/sum/max) в памяти процесса, отдаются на /metrics.
+    Всё разложено по текущему боту-арендатору.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.observations = {}
+
+    def incr(self, name, value=1):
+        key = (current_tenant().id, name)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value):
+        key = (current_tenant().id, name)
+        with self.lock:
+            o = self.observations.setdefault(key, {"count": 0, "sum": 0.0, "max": 0.0})
+            o["count"] += 1
+            o["sum"] += value
+            o["max"] = max(o["max"], value)
+
+    def snapshot(self):
+        out = {}
+        with self.lock:
+            for (tenant_id, name), value in self.counters.items():
+                out.setdefault(tenant_id, {"counters": {}, "observations": {}})["counters"][name] = value
+            for (tenant_id, name), o in self.observations.items():
+                out.setdefault(tenant_id, {"counters": {}, "observations": {}})["observations"][name] = {
+                    **o, "avg": o["sum"] / o["count"] if o["count"] else 0.0,
+                }
+        return out
+
+
+metrics = Metrics()
+
+
 # ================================
 # SUPABASE HELPERS
 # ================================
 
 
 def supabase_headers(json_mode=False):
+    tenant = current_tenant()
     headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "apikey": tenant.supabase_key,
+        "Authorization": f"Bearer {tenant.supabase_key}",
     }
+    if tenant.supabase_schema:
+        headers["Accept-Profile"] = tenant.supabase_schema
     if json_mode:
         headers["Content-Type"] = "application/json"
+        if tenant.supabase_schema:
+            headers["Content-Profile"] = tenant.supabase_schema
     return headers
 
 
-def supabase_select(table, match):
-    url = f"{SUPABASE_URL}/rest/v1/{table}"
+def supabase_table_url(table):
+    return f"{current_tenant().supabase_url}/rest/v1/{table}"
+
+
+def supabase_select(table, match, strict=False):
+    """
+    Строки или [] при ошибке. strict=True — ошибку не глотаем, а поднимаем:
+    тем, кто пишет по прочитанному, важно отличать «строк нет» от «не прочитали».
+    """
+    failover = get_failover()
+    if failover and failover.degraded():
+        # пока база лежит или очередь не догнана — читаем свой локальный снимок
+        rows = failover.snapshot_get(table, match)
+        if rows is not None:
+            metrics.incr("supabase.snapshot_hits")
+            return rows
+        if failover.is_down():
+            if strict:
+                raise SupabaseUnavailable("degraded mode, no local snapshot")
+            return []
+    url = supabase_table_url(table)
     params = {"select": "*"}
     params.update(match)
     try:
-        r = requests.get(url, headers=supabase_headers(), params=params, timeout=15)
+        r = http().get(url, headers=supabase_headers(), params=params, timeout=15)
+        if r.status_code >= 500:
+            raise SupabaseUnavailable(f"HTTP {r.status_code}")
         data = r.json()
         if isinstance(data, list):
+            if failover:
+                failover.mark_up()
+                failover.snapshot_put(table, match, data)
             return data
-        return []
+        raise ValueError(f"unexpected PostgREST response: {str(data)[:200]}")
     except Exception as e:
         print("supabase_select error:", e)
+        if failover and is_unavailable(e):
+            failover.mark_down(e)
+            rows = failover.snapshot_get(table, match)
+            if rows is not None:
+                metrics.incr("supabase.snapshot_hits")
+                return rows
+        if strict:
+            raise
         return []
 
 
-def supabase_upsert(table, data):
-    url = f"{SUPABASE_URL}/rest/v1/{table}"
+SUPABASE_PAGE_SIZE = int(os.environ.get("SUPABASE_PAGE_SIZE", "500"))
+SUPABASE_IN_BATCH = int(os.environ.get("SUPABASE_IN_BATCH", "200"))
+
+
+def supabase_fetch(table, params):
+    """
+    Как supabase_select, но ошибки не глотает: массовым задачам важно отличать
+    «строк нет» от «база не ответила», чтобы продолжить с чекпоинта.
+    """
+    url = supabase_table_url(table)
+    r = http().get(url, headers=supabase_headers(), params=params, timeout=30)
+    r.raise_for_status()
+    data = r.json()
+    if not isinstance(data, list):
+        raise ValueError(f"unexpected PostgREST response: {str(data)[:200]}")
+    return data
+
+
+def supabase_select_keyset(table, filters=None, key="user_id", select="*", after=None,
+                           page_size=None):
+    """
+    Постраничное чтение по ключу (key > last ORDER BY key) вместо OFFSET:
+    каждая страница — индексный поиск, память — одна страница. Отдаёт списки строк.
+    """
+    page_size = page_size or SUPABASE_PAGE_SIZE
+    last = after
+    while True:
+        params = {"select": select, "order": f"{key}.asc", "limit": str(page_size)}
+        params.update(filters or {})
+        if last is not None:
+            cond = f"gt.{last}"
+            params[key] = [params[key], cond] if key in params else cond
+        page = supabase_fetch(table, params)
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1][key]
+
+
+def postgrest_in(values):
+    quoted = ['"' + str(v).replace('"', '\\"') + '"' for v in values]
+    return "in.(" + ",".join(quoted) + ")"
+
+
+def supabase_select_in(table, column, values, filters=None, select="*"):
+    """
+    Пакетное чтение через column=in.(...) — один запрос на SUPABASE_IN_BATCH значений
+    вместо запроса на каждого пользователя.
+    """
+    values = list(values)
+    rows = []
+    for i in range(0, len(values), SUPABASE_IN_BATCH):
+        params = {"select": select, column: postgrest_in(values[i: i + SUPABASE_IN_BATCH])}
+        params.update(filters or {})
+        rows.extend(supabase_fetch(table, params))
+    return rows
+
+
+def supabase_upsert(table, data, strict=False):
+    return supabase_write("upsert", table, data, strict)
+
+
+def supabase_insert(table, data, strict=False):
+    return supabase_write("insert", table, data, strict)
+
+
+def supabase_write(kind, table, data, strict=False):
+    """
+    upsert/insert в PostgREST. Если база недоступна (или в очереди уже есть
+    недописанное — порядок важнее), строки уходят в локальную очередь и
+    дописываются фоновым повтором (см. SupabaseFailover).
+    strict=True — как supabase_fetch: без очереди, любая ошибка поднимается.
+    """
+    failover = get_failover()
+    if strict:
+        if failover and failover.degraded():
+            raise SupabaseUnavailable("degraded mode, write not attempted")
+        headers = supabase_headers(json_mode=True)
+        if kind == "upsert":
+            headers["Prefer"] = "resolution=merge-duplicates"
+        r = http().post(supabase_table_url(table), headers=headers, data=json.dumps(data), timeout=30)
+        r.raise_for_status()
+        if failover:
+            failover.snapshot_write(kind, table, data)
+        return r.json() if r.content else []
+    if failover:
+        failover.snapshot_write(kind, table, data)
+        if failover.degraded():
+            failover.enqueue(kind, table, data)
+            return []
+    headers = supabase_headers(json_mode=True)
+    if kind == "upsert":
+        headers["Prefer"] = "resolution=merge-duplicates"
     try:
-        r = requests.post(
-            url,
-            headers={**supabase_headers(json_mode=True), "Prefer": "resolution=merge-duplicates"},
+        r = http().post(
+            supabase_table_url(table),
+            headers=headers,
             data=json.dumps(data),
             timeout=15,
         )
+        if r.status_code >= 500:
+            raise SupabaseUnavailable(f"HTTP {r.status_code}")
+        if failover:
+            failover.mark_up()
         try:
             return r.json()
         except Exception:
             return []
     except Exception as e:
-        print("supabase_upsert error:", e)
+        print(f"supabase_{kind} error:", e)
+        if failover and is_unavailable(e):
+            failover.mark_down(e)
+            failover.enqueue(kind, table, data)
         return []
 
 
-def supabase_insert(table, data):
-    url = f"{SUPABASE_URL}/rest/v1/{table}"
-    try:
-        r = requests.post(
-            url,
-            headers=supabase_headers(json_mode=True),
-            data=json.dumps(data),
-            timeout=15,
-        )
+# ================================
+# SUPABASE FAILOVER
+# ================================
+
+FAILOVER_ENABLED = os.environ.get("FAILOVER_ENABLED", "1") == "1"
+FAILOVER_PATH = os.environ.get("FAILOVER_PATH", "supabase_failover.sqlite3")
+FAILOVER_SNAPSHOT_PATH = os.environ.get("FAILOVER_SNAPSHOT_PATH", "supabase_snapshot.sqlite3")
+# Строки снимка, не обновлявшиеся столько дней, выкидываются (профили ушедших пользователей)
+FAILOVER_SNAPSHOT_DAYS = int(os.environ.get("FAILOVER_SNAPSHOT_DAYS", "30"))
+# Аренда повтора: пока она жива, очередь арендатора дописывает только один процесс
+FAILOVER_LEASE_SECONDS = float(os.environ.get("FAILOVER_LEASE_SECONDS", "120"))
+# Сколько секунд после сбоя не ходить в базу из обработчиков (только повтор очереди)
+FAILOVER_RETRY_SECONDS = float(os.environ.get("FAILOVER_RETRY_SECONDS", "15"))
+FAILOVER_REPLAY_INTERVAL = float(os.environ.get("FAILOVER_REPLAY_INTERVAL", "5"))
+FAILOVER_REPLAY_BATCH = int(os.environ.get("FAILOVER_REPLAY_BATCH", "500"))
+
+# Снимок: какие таблицы и по каким eq-фильтрам кэшируются локально.
+# Для profiles/diary_days это ещё и ключ upsert — по нему схлопываются повторы.
+FAILOVER_SNAPSHOT_KEYS = {
+    "profiles": ("user_id",),
+    "diary_days": ("user_id", "day"),
+    "meals": ("user_id", "day"),
+}
+FAILOVER_UPSERT_KEYS = {
+    "profiles": ("user_id",),
+    "diary_days": ("user_id", "day"),
+}
+# Естественные ключи вставок: при повторе дубликаты игнорируются (нужен unique-индекс)
+FAILOVER_INSERT_KEYS = json.loads(os.environ.get("FAILOVER_INSERT_KEYS") or json.dumps({
+    "meals": "user_id,day,meal_number",
+    "meal_items": "user_id,day,meal_number,position",
+    "weight_log": "user_id,ts",
+}))
+
+
+class SupabaseUnavailable(Exception):
+    pass
+
+
+def is_unavailable(e):
+    """
+    Сетевая ошибка или 5xx — база недоступна; 4xx и прочее — ошибка запроса.
+    """
+    import requests
+
+    return isinstance(e, (SupabaseUnavailable, requests.ConnectionError, requests.Timeout))
+
+
+def _rows(data):
+    return data if isinstance(data, list) else [data]
+
+
+class SupabaseFailover:
+    """
+    Деградированный режим на случай недоступного Supabase, по арендаторам:
+    - снимок: последние прочитанные/записанные строки профилей и дневника
+      (отдельная SQLite, synchronous=NORMAL — это кэш, fsync на горячем пути не нужен);
+    - очередь: неотправленные upsert/insert (своя SQLite, synchronous=FULL),
+      переживает перезапуск и общая для всех воркеров на хосте;
+    - повтор: фоновый поток пачками дописывает очередь, когда база вернулась.
+    Есть ли недописанное, решает сама очередь, а не память процесса: пока она не пуста,
+    любой воркер пишет в неё же, и старый итог не перетрёт новый. Повторяет
+    один процесс за раз (аренда в replay_lease).
+    Upsert'ы по одному ключу схлопываются до последнего, вставки повторяются
+    с on_conflict + ignore-duplicates, так что повтор пачки безопасен.
+    """
+
+    def __init__(self, queue_path, snapshot_path):
+        import sqlite3
+
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(queue_path, check_same_thread=False, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # очередь — единственная копия записи, поэтому fsync на каждый коммит
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS write_queue (
+                id INTEGER PRIMARY KEY,
+                tenant TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                tbl TEXT NOT NULL,
+                row TEXT NOT NULL,
+                failed TEXT
+            );
+            CREATE INDEX IF NOT EXISTS write_queue_tenant ON write_queue (tenant, id) WHERE failed IS NULL;
+            CREATE TABLE IF NOT EXISTS replay_lease (
+                tenant TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+        """)
+        self.snap_lock = threading.Lock()
+        self.snap = sqlite3.connect(snapshot_path, check_same_thread=False, timeout=10)
+        self.snap.execute("PRAGMA journal_mode=WAL")
+        self.snap.execute("PRAGMA synchronous=NORMAL")
+        self.snap.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshot (
+                tenant TEXT NOT NULL,
+                tbl TEXT NOT NULL,
+                key TEXT NOT NULL,
+                day TEXT,
+                rows TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (tenant, tbl, key)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS snapshot_updated ON snapshot (updated);
+        """)
+        self.state = {}
+
+    # --- состояние базы ---
+
+    def _state(self):
+        return self.state.setdefault(current_tenant().id, {"down_until": 0.0, "down_since": None, "last_error": None})
+
+    def is_down(self):
+        return time.time() < self._state()["down_until"]
+
+    def has_pending(self):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM write_queue WHERE tenant = ? AND failed IS NULL LIMIT 1",
+                (current_tenant().id,),
+            ).fetchone()
+        return row is not None
+
+    def degraded(self):
+        return self.is_down() or self.has_pending()
+
+    def mark_down(self, e):
+        st = self._state()
+        if st["down_since"] is None:
+            st["down_since"] = time.time()
+            metrics.incr("supabase.outages")
+        st["down_until"] = time.time() + FAILOVER_RETRY_SECONDS
+        st["last_error"] = f"{type(e).__name__}: {e}"[:200]
+
+    def mark_up(self):
+        st = self._state()
+        if st["down_since"] is not None:
+            metrics.observe("supabase.outage_seconds", time.time() - st["down_since"])
+            st["down_since"] = None
+        st["down_until"] = 0.0
+
+    # --- снимок ---
+
+    @staticmethod
+    def _match_key(table, match):
+        cols = FAILOVER_SNAPSHOT_KEYS.get(table)
+        if not cols or set(match) != set(cols):
+            return None
+        values = []
+        for c in cols:
+            v = str(match[c])
+            if not v.startswith("eq."):
+                return None
+            values.append(v[3:])
+        return values
+
+    def snapshot_get(self, table, match):
+        values = self._match_key(table, match)
+        if values is None:
+            return None
+        with self.snap_lock:
+            row = self.snap.execute(
+                "SELECT rows FROM snapshot WHERE tenant = ? AND tbl = ? AND key = ?",
+                (current_tenant().id, table, json.dumps(values)),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def snapshot_put(self, table, match, rows):
+        values = self._match_key(table, match)
+        if values is None:
+            return
+        cols = FAILOVER_SNAPSHOT_KEYS[table]
+        day = values[cols.index("day")] if "day" in cols else None
+        with self.snap_lock, self.snap:
+            self.snap.execute(
+                "INSERT OR REPLACE INTO snapshot (tenant, tbl, key, day, rows, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (current_tenant().id, table, json.dumps(values), day, json.dumps(rows, default=str), time.time()),
+            )
+
+    def snapshot_write(self, kind, table, data):
+        """
+        Запись сквозь снимок: upsert сливается со строкой по ключу, insert дописывается,
+        чтобы чтение в деградированном режиме видело свои же записи.
+        """
+        cols = FAILOVER_SNAPSHOT_KEYS.get(table)
+        if not cols:
+            return
+        for new in _rows(data):
+            if not all(c in new for c in cols):
+                continue
+            match = {c: f"eq.{new[c]}" for c in cols}
+            rows = self.snapshot_get(table, match)
+            if rows is None:
+                if kind == "insert":
+                    # не знаем, что уже лежит в базе — пусть следующий select решит
+                    continue
+                rows = []
+            if kind == "upsert" and rows:
+                rows = [{**rows[0], **new}]
+            else:
+                rows = rows + [new]
+            self.snapshot_put(table, match, rows)
+
+    def snapshot_prune(self, before_day):
+        """
+        Дневные строки старше before_day и всё, что не обновлялось FAILOVER_SNAPSHOT_DAYS.
+        """
+        stale = time.time() - FAILOVER_SNAPSHOT_DAYS * 86400
+        with self.snap_lock, self.snap:
+            self.snap.execute("DELETE FROM snapshot WHERE (day IS NOT NULL AND day < ?) OR updated < ?",
+                              (before_day, stale))
+
+    # --- очередь ---
+
+    def enqueue(self, kind, table, data):
+        rows = _rows(data)
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO write_queue (tenant, kind, tbl, row) VALUES (?, ?, ?, ?)",
+                [(current_tenant().id, kind, table, json.dumps(r, default=str)) for r in rows],
+            )
+        metrics.incr("supabase.queued", len(rows))
+
+    def _lease(self, tenant_id, owner):
+        now = time.time()
+        with self.lock, self.db:
+            cur = self.db.execute(
+                "INSERT INTO replay_lease (tenant, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (tenant) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE replay_lease.owner = excluded.owner OR replay_lease.expires < ?",
+                (tenant_id, owner, now + FAILOVER_LEASE_SECONDS, now),
+            )
+        return cur.rowcount == 1
+
+    def _release(self, tenant_id, owner):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM replay_lease WHERE tenant = ? AND owner = ?", (tenant_id, owner))
+
+    def replay(self):
+        """
+        Дописывает очередь текущего арендатора, пока она не опустеет или база снова не упадёт.
+        Возвращает число дописанных строк; 0 — если повторяет другой процесс.
+        """
+        tenant_id = current_tenant().id
+        owner = f"{os.getpid()}:{threading.get_ident()}"
+        if not self._lease(tenant_id, owner):
+            return 0
         try:
-            return r.json()
-        except Exception:
-            return []
-    except Exception as e:
-        print("supabase_insert error:", e)
-        return []
+            return self._replay(tenant_id, owner)
+        finally:
+            self._release(tenant_id, owner)
+
+    def _replay(self, tenant_id, owner):
+        done = 0
+        while True:
+            with self.lock:
+                batch = self.db.execute(
+                    "SELECT id, kind, tbl, row FROM write_queue WHERE tenant = ? AND failed IS NULL "
+                    "ORDER BY id LIMIT ?",
+                    (tenant_id, FAILOVER_REPLAY_BATCH),
+                ).fetchall()
+            if not batch:
+                break
+            # группы: одна таблица, один вид записи, одинаковый набор колонок (требование PostgREST)
+            groups = OrderedDict()
+            for entry_id, kind, table, raw in batch:
+                row = json.loads(raw)
+                group = groups.setdefault((kind, table, tuple(sorted(row))), {"ids": [], "rows": OrderedDict()})
+                group["ids"].append(entry_id)
+                keys = FAILOVER_UPSERT_KEYS.get(table) if kind == "upsert" else None
+                row_key = tuple(row.get(k) for k in keys) if keys else entry_id
+                group["rows"].pop(row_key, None)
+                group["rows"][row_key] = row
+            for (kind, table, _), group in groups.items():
+                # продлеваем аренду перед каждой отправкой: истёкшая — значит, повторяет уже другой
+                if not self._lease(tenant_id, owner):
+                    return done
+                try:
+                    failed = self._send(kind, table, list(group["rows"].values()))
+                except Exception as e:
+                    print("supabase replay error:", e)
+                    if is_unavailable(e):
+                        self.mark_down(e)
+                    return done
+                with self.lock, self.db:
+                    if failed:
+                        # 4xx не пройдёт и при повторе: откладываем, чтобы не держать очередь
+                        self.db.executemany("UPDATE write_queue SET failed = ? WHERE id = ?",
+                                            [(failed, i) for i in group["ids"]])
+                        metrics.incr("supabase.replay_failed", len(group["ids"]))
+                    else:
+                        self.db.executemany("DELETE FROM write_queue WHERE id = ?", [(i,) for i in group["ids"]])
+                done += len(group["rows"])
+                metrics.incr("supabase.replayed", len(group["rows"]))
+        self.mark_up()
+        return done
+
+    @staticmethod
+    def _send(kind, table, rows):
+        headers = supabase_headers(json_mode=True)
+        url = supabase_table_url(table)
+        if kind == "upsert":
+            headers["Prefer"] = "resolution=merge-duplicates"
+        elif table in FAILOVER_INSERT_KEYS:
+            headers["Prefer"] = "resolution=ignore-duplicates"
+            url += f"?on_conflict={FAILOVER_INSERT_KEYS[table]}"
+        r = http().post(url, headers=headers, data=json.dumps(rows), timeout=30)
+        if r.status_code >= 500:
+            raise SupabaseUnavailable(f"HTTP {r.status_code}")
+        if r.status_code >= 400:
+            return f"HTTP {r.status_code}: {r.text[:200]}"
+        return None
+
+    def health(self):
+        with self.lock:
+            counts = self.db.execute(
+                "SELECT tenant, failed IS NULL, COUNT(*) FROM write_queue GROUP BY tenant, failed IS NULL"
+            ).fetchall()
+        pending = {t: n for t, ok, n in counts if ok}
+        failed = {t: n for t, ok, n in counts if not ok}
+        out = {}
+        for tenant in TENANTS.values():
+            with tenant_context(tenant):
+                st = self._state()
+                out[tenant.id] = {
+                    "supabase": "down" if self.is_down() else "up",
+                    "down_since": st["down_since"],
+                    "last_error": st["last_error"],
+                    "pending_writes": pending.get(tenant.id, 0),
+                    "failed_writes": failed.get(tenant.id, 0),
+                }
+        return out
+
+
+_failover = None
+_failover_lock = threading.Lock()
+_replayer_stop = threading.Event()
+
+
+def get_failover():
+    global _failover
+    if not FAILOVER_ENABLED:
+        return None
+    # после fork (gunicorn --preload) соединения SQLite родителя не используем
+    if _failover is None or _failover.pid != os.getpid():
+        with _failover_lock:
+            if _failover is None or _failover.pid != os.getpid():
+                _failover = SupabaseFailover(FAILOVER_PATH, FAILOVER_SNAPSHOT_PATH)
+    return _failover
+
+
+def replay_loop(stop):
+    pruned = 0.0
+    while not stop.wait(FAILOVER_REPLAY_INTERVAL):
+        failover = get_failover()
+        if time.time() - pruned > 3600:
+            # самые дальние зоны расходятся не больше чем на двое суток
+            before = (datetime.datetime.utcnow() - datetime.timedelta(days=2)).strftime("%Y%m%d")
+            failover.snapshot_prune(before)
+            pruned = time.time()
+        for tenant in TENANTS.values():
+            with tenant_context(tenant):
+                if not failover.is_down() and failover.has_pending():
+                    try:
+                        failover.replay()
+                    except Exception as e:
+                        print("replay_loop error:", tenant.id, e)
+
+
+def start_replayer():
+    t = threading.Thread(target=replay_loop, args=(_replayer_stop,), name="supabase-replay", daemon=True)
+    t.start()
+    return t
 
 
 # ================================
@@ -110,8 +886,8 @@ LANG_CHOICES_TEXT = (
     "Просто отправь 1, 2 или 3."
 )
 
-TEXT = {
-    "ru": {
+def _text_ru():
+    return {
         "profile_intro": (
             "Давай настроим твой профиль, чтобы я мог точнее считать калории.\n\n"
             "Активность:\n"
@@ -176,6 +952,19 @@ TEXT = {
             "Попробуй ещё раз: перечисли продукты и примерные порции — по одному-двум блюдам в строке."
         ),
         "meal_header": "Разбор приёма пищи:",
+        "history_header": "Твои прошлые приёмы пищи:",
+        "history_empty": "История пока пуста — она заполнится, когда ты начнёшь вносить еду.",
+        "history_repeat_hint": "Чтобы повторить приём, пришли /repeat и номер, например: /repeat 12 (или /repeat овсянка).",
+        "repeat_not_found": "Не нашёл такой приём в истории. Посмотри список: /history",
+        "voice_busy": "Сейчас распознаю много голосовых — пришли это ещё раз чуть позже или напиши текстом.",
+        "diary_unavailable": "Не получилось открыть дневник за сегодня — приём не записан. Пришли его ещё раз чуть позже.",
+        "cannot_parse_voice": "Не получилось распознать голосовое. Попробуй ещё раз или напиши текстом.",
+        "voice_heard": "🎙 Услышал: «{text}»",
+        "photo_busy": "Сейчас обрабатываю много фото — пришли это ещё раз через минуту или опиши еду текстом.",
+        "cannot_parse_photo": (
+            "Не получилось разобрать еду на фото. Попробуй снять поближе и при хорошем свете "
+            "или просто опиши приём пищи текстом."
+        ),
         "daily_summary": (
             "\n\nИтого за этот приём: {meal_kcal} ккал.\n"
             "Съедено сегодня: {total_kcal} ккал.\n"
@@ -200,9 +989,14 @@ TEXT = {
             "• /status — показать твою норму, текущий дневник и остаток по калориям.\n"
             "• /calc — то же самое, плюс краткое напоминание про дефицит.\n"
             "• /reset — сброс калорий за сегодня (начать день заново).\n"
+            "• /forecast — прогноз веса по твоему дневнику.\n"
+            "• /trend — сглаженный тренд веса и темп в неделю.\n"
             "• /weight — как обновить вес.\n"
             "• /height — как обновить рост.\n"
-            "• /age — как обновить возраст.\n\n"
+            "• /age — как обновить возраст.\n"
+            "• /tz — часовой пояс (когда у тебя начинается новый день).\n"
+            "• /history — прошлые приёмы пищи (можно с поиском: /history овсянка).\n"
+            "• /repeat — повторить приём из истории без нового расчёта.\n\n"
             "Дальше просто присылай, что ты съел(а), в свободной форме — я разберу, "
             "оценю калории и покажу остаток до дневной нормы."
         ),
@@ -232,14 +1026,54 @@ TEXT = {
             "Чтобы обновить возраст, пришли сообщение:\n"
             "«Возраст 35» (или другой возраст)."
         ),
+        "cmd_tz_hint": (
+            "Сейчас твой часовой пояс: {tz}.\n"
+            "Чтобы сменить его, пришли: «/tz Europe/Moscow» (название пояса в формате IANA)."
+        ),
+        "tz_saved": "Часовой пояс сохранён: {tz}. Сейчас у тебя {time} — день будет считаться по нему ✅",
+        "tz_invalid": "Не знаю такой часовой пояс: «{tz}». Пример: «/tz Europe/Moscow».",
+        "weight_saved": (
+            "Записал вес: {weight} кг ✅\n"
+            "Тренд: {trend} кг ({rate:+.2f} кг в неделю).\n"
+            "Дневная норма пересчитана: {kcal} ккал."
+        ),
+        "trend": (
+            "Вес по последнему замеру: {weight} кг.\n"
+            "Сглаженный тренд: {trend} кг, темп: {rate:+.2f} кг в неделю (замеров: {points}).\n"
+            "Дневная норма по тренду: {kcal} ккал."
+        ),
+        "trend_empty": "Замеров веса пока нет. Пришли, например, «Вес 87».",
+        "forecast": (
+            "Прогноз по дневнику за {days} дн.:\n"
+            "• в среднем съедаешь: {avg_intake} ккал в день;\n"
+            "• баланс к расходу: {avg_balance:+d} ккал в день;\n"
+            "• изменение веса: {kg_per_week:+.2f} кг в неделю;\n"
+            "• вес через 30 дней: около {weight_30d} кг."
+        ),
+        "forecast_eta": "\n\nЦели {goal} кг ты достигнешь примерно к {date}.",
+        "forecast_no_eta": "\n\nПри таком темпе вес не движется к цели — попробуй немного скорректировать питание.",
+        "forecast_not_enough": "Для прогноза нужно хотя бы {days} дня с записями в дневнике (не считая сегодняшнего).",
+        "evening_summary": (
+            "Итоги дня 🌙\n\n"
+            "Съедено сегодня: {total_kcal} ккал.\n"
+            "Твоя дневная норма: {target_kcal} ккал.\n"
+            "Остаток: {left_kcal} ккал."
+        ),
+        "evening_reminder": (
+            "Сегодня в дневнике пока пусто 🙂\n"
+            "Если ты ел(а) — просто опиши приёмы пищи, я посчитаю калории."
+        ),
         "calc_hint": (
             "Напоминание: дефицит калорий — это когда ты системно ешь немного меньше, чем тратишь.\n"
             "Я уже заложил умеренный дефицит в твою норму. Главное — смотреть на среднюю картину по неделе, "
             "а не зацикливаться на одном дне."
         ),
-    },
-    # Для краткости: en/sr попроще, но с той же логикой
-    "en": {
+    }
+
+
+# Для краткости: en/sr попроще, но с той же логикой
+def _text_en():
+    return {
         "profile_intro": (
             "Let’s set up your profile so I can track calories correctly.\n\n"
             "Activity:\n"
@@ -303,6 +1137,19 @@ TEXT = {
             "Please try again and list items with approximate portions."
         ),
         "meal_header": "Meal breakdown:",
+        "history_header": "Your past meals:",
+        "history_empty": "No history yet — it fills up as you log meals.",
+        "history_repeat_hint": "To log one again, send /repeat and its number, e.g. /repeat 12 (or /repeat oatmeal).",
+        "repeat_not_found": "I couldn’t find that meal in your history. See the list: /history",
+        "voice_busy": "I’m transcribing a lot of voice messages right now — resend later or type the meal.",
+        "diary_unavailable": "I couldn’t open today’s diary, so the meal wasn’t logged. Please send it again a bit later.",
+        "cannot_parse_voice": "I couldn’t transcribe this voice message. Try again or type the meal.",
+        "voice_heard": "🎙 I heard: \"{text}\"",
+        "photo_busy": "I’m processing a lot of photos right now — resend this in a minute or describe the meal in text.",
+        "cannot_parse_photo": (
+            "I couldn’t recognise the food in this photo. Try a closer shot in good light "
+            "or just describe the meal in text."
+        ),
         "daily_summary": (
             "\n\nThis meal: {meal_kcal} kcal.\n"
             "Total today: {total_kcal} kcal.\n"
@@ -327,9 +1174,14 @@ TEXT = {
             "• /status – your profile, daily target and today’s summary.\n"
             "• /calc – same as /status plus a short reminder about deficit.\n"
             "• /reset – reset today’s calories.\n"
+            "• /forecast – weight forecast from your diary.\n"
+            "• /trend – smoothed weight trend and weekly rate.\n"
             "• /weight – how to update weight.\n"
             "• /height – how to update height.\n"
             "• /age – how to update age.\n"
+            "• /tz – your timezone (when your day starts).\n"
+            "• /history – past meals (search too: /history oatmeal).\n"
+            "• /repeat – log a meal from history again, instantly.\n"
         ),
         "status_no_profile": "Profile is not set yet. Send /start and fill it first.",
         "status": (
@@ -351,13 +1203,53 @@ TEXT = {
         ),
         "cmd_height_hint": "To update your height, send: \"Height 181\".",
         "cmd_age_hint": "To update your age, send: \"Age 35\".",
+        "cmd_tz_hint": (
+            "Your timezone is {tz}.\n"
+            "To change it, send: \"/tz Europe/London\" (IANA timezone name)."
+        ),
+        "tz_saved": "Timezone saved: {tz}. It’s {time} for you now — your day follows this zone ✅",
+        "tz_invalid": "Unknown timezone: \"{tz}\". Example: \"/tz Europe/London\".",
+        "weight_saved": (
+            "Weight saved: {weight} kg ✅\n"
+            "Trend: {trend} kg ({rate:+.2f} kg/week).\n"
+            "Daily target recalculated: {kcal} kcal."
+        ),
+        "trend": (
+            "Last weigh-in: {weight} kg.\n"
+            "Smoothed trend: {trend} kg, rate: {rate:+.2f} kg/week ({points} weigh-ins).\n"
+            "Daily target from trend: {kcal} kcal."
+        ),
+        "trend_empty": "No weigh-ins yet. Send e.g. \"Weight 87\".",
+        "forecast": (
+            "Forecast from {days} logged days:\n"
+            "• average intake: {avg_intake} kcal/day;\n"
+            "• balance vs. burn: {avg_balance:+d} kcal/day;\n"
+            "• weight change: {kg_per_week:+.2f} kg/week;\n"
+            "• weight in 30 days: about {weight_30d} kg."
+        ),
+        "forecast_eta": "\n\nYou should reach your {goal} kg goal around {date}.",
+        "forecast_no_eta": "\n\nAt this pace your weight isn’t moving toward the goal — try adjusting your intake a bit.",
+        "forecast_not_enough": "I need at least {days} logged days (not counting today) for a forecast.",
+        "evening_summary": (
+            "Your day so far 🌙\n\n"
+            "Eaten today: {total_kcal} kcal.\n"
+            "Daily target: {target_kcal} kcal.\n"
+            "Remaining: {left_kcal} kcal."
+        ),
+        "evening_reminder": (
+            "Nothing logged today yet 🙂\n"
+            "If you ate something, just describe your meals and I’ll count the calories."
+        ),
         "calc_hint": (
             "Reminder: a calorie deficit means you consistently eat a bit less than you burn. "
             "I already include a moderate deficit in your target. Focus on weekly averages, "
             "not a single day."
         ),
-    },
-    "sr": {
+    }
+
+
+def _text_sr():
+    return {
         "profile_intro": (
             "Hajde da podesimo tvoj profil da bih tačnije računao kalorije.\n\n"
             "Aktivnost:\n"
@@ -421,6 +1313,19 @@ TEXT = {
             "posebnim nabrajanjem stavki."
         ),
         "meal_header": "Analiza obroka:",
+        "history_header": "Tvoji prethodni obroci:",
+        "history_empty": "Istorija je još prazna — popuniće se kad počneš da unosiš obroke.",
+        "history_repeat_hint": "Da ponoviš obrok, pošalji /repeat i broj, npr. /repeat 12 (ili /repeat ovsena kaša).",
+        "repeat_not_found": "Nisam našao taj obrok u istoriji. Pogledaj listu: /history",
+        "voice_busy": "Trenutno obrađujem mnogo glasovnih poruka — pošalji kasnije ili napiši obrok.",
+        "diary_unavailable": "Nisam uspeo da otvorim današnji dnevnik, pa obrok nije upisan. Pošalji ga ponovo malo kasnije.",
+        "cannot_parse_voice": "Nisam uspeo da prepoznam glasovnu poruku. Probaj ponovo ili napiši obrok.",
+        "voice_heard": "🎙 Čuo sam: \"{text}\"",
+        "photo_busy": "Trenutno obrađujem mnogo fotografija — pošalji ponovo za minut ili opiši obrok tekstom.",
+        "cannot_parse_photo": (
+            "Nisam uspeo da prepoznam hranu na fotografiji. Probaj snimak izbliza i na dobrom svetlu "
+            "ili opiši obrok tekstom."
+        ),
         "daily_summary": (
             "\n\nOvaj obrok: {meal_kcal} kcal.\n"
             "Ukupno danas: {total_kcal} kcal.\n"
@@ -443,7 +1348,12 @@ TEXT = {
             "• /status – profil + današnji rezime.\n"
             "• /calc – isto, uz kratko objašnjenje deficita.\n"
             "• /reset – reset današnjih kalorija.\n"
+            "• /forecast – prognoza težine na osnovu dnevnika.\n"
+            "• /trend – izglađeni trend težine i tempo nedeljno.\n"
             "• /weight, /height, /age – kako da ažuriraš podatke.\n"
+            "• /tz – vremenska zona (kada ti počinje novi dan).\n"
+            "• /history – prethodni obroci (i pretraga: /history ovsena kaša).\n"
+            "• /repeat – ponovo upiši obrok iz istorije.\n"
         ),
         "status_no_profile": "Profil još nije podešen. Pošalji /start.",
         "status": (
@@ -462,136 +1372,622 @@ TEXT = {
         "cmd_weight_hint": "Za ažuriranje težine pošalji: \"Težina 88\".",
         "cmd_height_hint": "Za ažuriranje visine pošalji: \"Visina 181\".",
         "cmd_age_hint": "Za ažuriranje godina pošalji: \"Godine 34\".",
+        "cmd_tz_hint": (
+            "Tvoja vremenska zona je {tz}.\n"
+            "Za promenu pošalji: \"/tz Europe/Belgrade\" (IANA naziv zone)."
+        ),
+        "tz_saved": "Vremenska zona je sačuvana: {tz}. Kod tebe je sada {time} ✅",
+        "tz_invalid": "Ne poznajem vremensku zonu: \"{tz}\". Primer: \"/tz Europe/Belgrade\".",
+        "weight_saved": (
+            "Težina je upisana: {weight} kg ✅\n"
+            "Trend: {trend} kg ({rate:+.2f} kg nedeljno).\n"
+            "Dnevna norma je preračunata: {kcal} kcal."
+        ),
+        "trend": (
+            "Poslednje merenje: {weight} kg.\n"
+            "Izglađeni trend: {trend} kg, tempo: {rate:+.2f} kg nedeljno (merenja: {points}).\n"
+            "Dnevna norma prema trendu: {kcal} kcal."
+        ),
+        "trend_empty": "Još nema merenja. Pošalji npr. \"Težina 88\".",
+        "forecast": (
+            "Prognoza na osnovu {days} dana iz dnevnika:\n"
+            "• prosečan unos: {avg_intake} kcal dnevno;\n"
+            "• bilans prema potrošnji: {avg_balance:+d} kcal dnevno;\n"
+            "• promena težine: {kg_per_week:+.2f} kg nedeljno;\n"
+            "• težina za 30 dana: oko {weight_30d} kg."
+        ),
+        "forecast_eta": "\n\nCilj od {goal} kg dostićićeš otprilike do {date}.",
+        "forecast_no_eta": "\n\nOvim tempom težina se ne kreće ka cilju — probaj malo da prilagodiš ishranu.",
+        "forecast_not_enough": "Za prognozu treba bar {days} dana sa upisima u dnevnik (ne računajući danas).",
+        "evening_summary": (
+            "Rezime dana 🌙\n\n"
+            "Ukupno danas: {total_kcal} kcal.\n"
+            "Dnevna norma: {target_kcal} kcal.\n"
+            "Preostalo: {left_kcal} kcal."
+        ),
+        "evening_reminder": (
+            "Danas još ništa nije upisano 🙂\n"
+            "Ako si jeo/la, samo opiši obroke i izračunaću kalorije."
+        ),
         "calc_hint": (
             "Deficit kalorija znači da malo manje jedeš nego što trošiš. "
             "Norma već uključuje blagi deficit. Gledaj proseke po nedelji."
         ),
-    },
-}
+    }
 
 
-# ================================
-# HF ROUTER CHAT HELPER
-# ================================
+# Языковые пакеты собираются при первом обращении к языку
+TEXT = LazyTable({
+    "ru": _text_ru,
+    "en": _text_en,
+    "sr": _text_sr,
+})
 
 
-def call_hf_chat(system_prompt, user_prompt, response_format_json=False):
+def texts(lang):
     """
-    Вызов Hugging Face Router в формате /v1/chat/completions.
-    Возвращает message.content или None.
+    Тексты языка с правками текущего бота (Tenant.texts) поверх общих.
     """
-    if not AI_ENDPOINT or not AI_KEY or not AI_MODEL:
-        print("HF config missing")
-        return None
-
-    headers = {
-        "Authorization": f"Bearer {AI_KEY}",
-        "Content-Type": "application/json",
-    }
-
-    payload = {
-        "model": AI_MODEL,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        "temperature": 0.25,
-        "max_tokens": 512,
-    }
-
-    if response_format_json:
-        payload["response_format"] = {"type": "json_object"}
-
-    try:
-        r = requests.post(AI_ENDPOINT, headers=headers, json=payload, timeout=40)
-        if r.status_code != 200:
-            print("HF NON-200 RESPONSE:", r.status_code, r.text[:500])
-            return None
-        data = r.json()
-        return data["choices"][0]["message"]["content"]
-    except Exception as e:
-        print("HF chat error:", e)
-        return None
+    if lang not in TEXT:
+        lang = "ru"
+    tenant = current_tenant()
+    overrides = tenant.texts.get(lang)
+    if not overrides:
+        return TEXT[lang]
+    merged = tenant._merged_texts.get(lang)
+    if merged is None:
+        merged = tenant._merged_texts[lang] = {**TEXT[lang], **overrides}
+    return merged
 
 
 # ================================
-# PROFILE STORAGE & CALC
+# LLM BACKENDS
 # ================================
 
 
-def get_profile(user_id):
-    res = supabase_select("profiles", {"user_id": f"eq.{user_id}"})
-    return res[0] if res else None
+class ChatBackend(abc.ABC):
+    """
+    Бэкенд чата: chat(system_prompt, user_prompt, response_format_json) -> message.content или None.
+    """
 
+    name = "base"
 
-def save_profile(user_id, new_data):
-    existing = get_profile(user_id) or {}
-    merged = dict(existing)
-    merged.update(new_data)
-    merged["user_id"] = user_id
-    merged["updated_at"] = datetime.datetime.utcnow().isoformat()
-    supabase_upsert("profiles", merged)
+    @abc.abstractmethod
+    def chat(self, system_prompt, user_prompt, response_format_json=False):
+        ...
 
+    def available(self):
+        return True
 
-def get_today_key():
-    return datetime.datetime.now().strftime("%Y%m%d")
 
+class OpenAICompatibleBackend(ChatBackend):
+    """
+    Любой эндпоинт /v1/chat/completions: HF Router, vLLM, llama.cpp server, OpenAI и т.п.
+    """
 
-def get_diary(user_id, day):
-    res = supabase_select("diary_days", {"user_id": f"eq.{user_id}", "day": f"eq.{day}"})
-    if res:
-        return res[0]
-    blank = {"user_id": user_id, "day": day, "total_kcal": 0}
-    supabase_insert("diary_days", blank)
-    return blank
+    def __init__(self, name, endpoint, key, model, max_tokens=512):
+        self.name = name
+        self.endpoint = endpoint
+        self.key = key
+        self.model = model
+        self.max_tokens = max_tokens
 
+    def available(self):
+        return bool(self.endpoint and self.key and self.model)
 
-def update_diary_kcal(user_id, day, delta_kcal):
-    d = get_diary(user_id, day)
-    new_total = (d.get("total_kcal") or 0) + delta_kcal
-    supabase_upsert("diary_days", {
-        "user_id": user_id,
-        "day": day,
-        "total_kcal": new_total,
-    })
-    return new_total
+    def chat(self, system_prompt, user_prompt, response_format_json=False):
+        if not self.available():
+            print("HF config missing")
+            return None
 
+        headers = {
+            "Authorization": f"Bearer {self.key}",
+            "Content-Type": "application/json",
+        }
 
-def reset_diary_today(user_id):
-    day = get_today_key()
-    supabase_upsert("diary_days", {
-        "user_id": user_id,
-        "day": day,
-        "total_kcal": 0,
-    })
+        payload = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            "temperature": 0.25,
+            "max_tokens": self.max_tokens,
+        }
 
+        if response_format_json:
+            payload["response_format"] = {"type": "json_object"}
 
-def add_meal_record(user_id, day, meal_number, desc, kcal):
-    supabase_insert("meals", {
-        "user_id": user_id,
-        "day": day,
-        "meal_number": meal_number,
-        "description": desc,
-        "kcal": kcal,
-    })
+        return post_chat_completion(self.endpoint, headers, payload, metric_prefix=f"llm.{self.name}")
 
 
-def parse_profile(text):
+class LocalLlamaBackend(ChatBackend):
     """
-    Парсим профиль из свободного текста без обязательных двоеточий.
-    Формат: строки с ключевыми словами + число.
+    Модель GGUF внутри процесса (llama-cpp-python, CPU). Модель грузится один раз
+    в своём потоке; запросы идут через ограниченную очередь по одному —
+    llama.cpp всё равно занимает все выделенные ядра на один запрос.
+    Пока модель грузится (или если не загрузилась), available() = False
+    и роутер отправляет всё в удалённую модель.
     """
-    t = text.lower()
 
-    def find_int(labels):
-        pattern = r"(" + "|".join([re.escape(l) for l in labels]) + r")\s*[:\-]?\s*(\d+)"
-        m = re.search(pattern, t)
-        if not m:
+    def __init__(self, name, model_path, n_threads=4, n_ctx=2048, queue_size=8, max_tokens=512, timeout=60):
+        self.name = name
+        self.model_path = model_path
+        self.n_threads = n_threads
+        self.n_ctx = n_ctx
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.worker = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.load_error = None
+
+    def available(self):
+        if not self.model_path or self.load_error is not None:
+            return False
+        # первый вызов запускает загрузку в фоне, не дожидаясь её
+        self._ensure_started()
+        return self.ready.is_set()
+
+    def _ensure_started(self):
+        if self.worker is None:
+            with self.lock:
+                if self.worker is None:
+                    self.worker = threading.Thread(target=self._run, name=f"llm-{self.name}", daemon=True)
+                    self.worker.start()
+
+    def _run(self):
+        try:
+            from llama_cpp import Llama
+
+            llm = Llama(model_path=self.model_path, n_ctx=self.n_ctx, n_threads=self.n_threads, verbose=False)
+        except Exception as e:
+            print(f"local LLM {self.name} failed to load:", e)
+            metrics.incr(f"llm.{self.name}.load_failed")
+            self.load_error = e
+            llm = None
+        else:
+            self.ready.set()
+        while True:
+            messages, response_format_json, future, ctx = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            if llm is None:
+                # запросы, успевшие встать в очередь до сбоя, не ждут таймаута
+                future.set_exception(RuntimeError(f"local model not loaded: {self.load_error}"))
+                continue
+            try:
+                kwargs = {"messages": messages, "temperature": 0.25, "max_tokens": self.max_tokens}
+                if response_format_json:
+                    kwargs["response_format"] = {"type": "json_object"}
+                out = llm.create_chat_completion(**kwargs)
+                ctx.run(record_usage, f"llm.{self.name}", out.get("usage"))
+                future.set_result(out["choices"][0]["message"]["content"])
+            except Exception as e:
+                future.set_exception(e)
+
+    def chat(self, system_prompt, user_prompt, response_format_json=False):
+        if not self.available():
+            return None
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ]
+        future = Future()
+        try:
+            self.queue.put_nowait((messages, response_format_json, future, contextvars.copy_context()))
+        except queue.Full:
+            print("local LLM queue full")
+            return None
+        try:
+            return future.result(timeout=self.timeout)
+        except Exception as e:
+            future.cancel()
+            print("local LLM error:", e)
             return None
-        return int(m.group(2))
 
-    age = find_int(["возраст", "age", "godine"])
-    height = find_int(["рост", "height", "visina"])
+
+LOCAL_MODEL_PATH = os.environ.get("LOCAL_MODEL_PATH")
+LOCAL_MODEL_THREADS = int(os.environ.get("LOCAL_MODEL_THREADS", "4"))
+LOCAL_MODEL_QUEUE = int(os.environ.get("LOCAL_MODEL_QUEUE", "8"))
+
+# Компактная схема ответа укладывается в 256 токенов с запасом
+AI_MAX_TOKENS = int(os.environ.get("AI_MAX_TOKENS", "256"))
+
+remote_backend = OpenAICompatibleBackend("remote", AI_ENDPOINT, AI_KEY, AI_MODEL, max_tokens=AI_MAX_TOKENS)
+local_backend = LocalLlamaBackend(
+    "local", LOCAL_MODEL_PATH, n_threads=LOCAL_MODEL_THREADS, queue_size=LOCAL_MODEL_QUEUE,
+    max_tokens=AI_MAX_TOKENS,
+)
+# Удалённые бэкенды по моделям: арендаторы с одной моделью делят один объект
+_remote_backends = {AI_MODEL: remote_backend}
+
+
+def get_backend(route):
+    if route != "remote":
+        return local_backend
+    model = current_tenant().ai_model
+    backend = _remote_backends.get(model)
+    if backend is None:
+        backend = _remote_backends.setdefault(
+            model, OpenAICompatibleBackend("remote", AI_ENDPOINT, AI_KEY, model, max_tokens=AI_MAX_TOKENS),
+        )
+    return backend
+
+
+def call_hf_chat(system_prompt, user_prompt, response_format_json=False):
+    """
+    Вызов основной (удалённой) модели текущего бота в формате /v1/chat/completions.
+    Возвращает message.content или None.
+    """
+    return get_backend("remote").chat(system_prompt, user_prompt, response_format_json)
+
+
+def record_usage(metric_prefix, usage):
+    """
+    Токены на вызов из поля usage ответа (OpenAI-совместимый формат).
+    cached_tokens — сколько токенов промпта бэкенд взял из кэша префикса.
+    """
+    if not usage:
+        return
+    metrics.observe(f"{metric_prefix}.prompt_tokens", usage.get("prompt_tokens") or 0)
+    metrics.observe(f"{metric_prefix}.completion_tokens", usage.get("completion_tokens") or 0)
+    details = usage.get("prompt_tokens_details") or {}
+    if details.get("cached_tokens") is not None:
+        metrics.observe(f"{metric_prefix}.cached_prompt_tokens", details["cached_tokens"])
+
+
+def post_chat_completion(endpoint, headers, payload, metric_prefix="llm.remote"):
+    try:
+        r = http().post(endpoint, headers=headers, json=payload, timeout=40)
+        if r.status_code != 200:
+            print("HF NON-200 RESPONSE:", r.status_code, r.text[:500])
+            return None
+        data = r.json()
+        record_usage(metric_prefix, data.get("usage"))
+        return data["choices"][0]["message"]["content"]
+    except Exception as e:
+        print("HF chat error:", e)
+        return None
+
+
+def call_vision_chat(system_prompt, user_prompt, image_bytes, mime="image/jpeg"):
+    """
+    То же, что call_hf_chat, но с картинкой (OpenAI-совместимый image_url с data: URL).
+    """
+    if not AI_VISION_ENDPOINT or not AI_VISION_KEY or not AI_VISION_MODEL:
+        print("Vision config missing")
+        return None
+
+    headers = {
+        "Authorization": f"Bearer {AI_VISION_KEY}",
+        "Content-Type": "application/json",
+    }
+    image_url = f"data:{mime};base64," + base64.b64encode(image_bytes).decode("ascii")
+    payload = {
+        "model": AI_VISION_MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": [
+                {"type": "text", "text": user_prompt},
+                {"type": "image_url", "image_url": {"url": image_url}},
+            ]},
+        ],
+        "temperature": 0.25,
+        "max_tokens": AI_MAX_TOKENS,
+    }
+    return post_chat_completion(AI_VISION_ENDPOINT, headers, payload, metric_prefix="llm.vision")
+
+
+# ================================
+# TIMEZONES / DAY KEYS
+# ================================
+
+
+@lru_cache(maxsize=1024)
+def resolve_tz(name):
+    try:
+        return ZoneInfo(name)
+    except Exception:
+        return None
+
+
+# tz -> (начало дня UTC ts, конец дня UTC ts, ключ дня).
+# Пока текущий момент внутри окна, ключ дня — это один dict-lookup без zoneinfo.
+_tz_days = {}
+
+
+def local_midnight_ts(day, zone):
+    return datetime.datetime.combine(day, datetime.time(0), tzinfo=zone).timestamp()
+
+
+def tz_day_key(tz, now_ts=None):
+    if now_ts is None:
+        now_ts = time.time()
+    entry = _tz_days.get(tz)
+    if entry and entry[0] <= now_ts < entry[1]:
+        return entry[2]
+
+    zone = resolve_tz(tz) or resolve_tz(DEFAULT_TZ)
+    local_day = datetime.datetime.fromtimestamp(now_ts, zone).date()
+    start = local_midnight_ts(local_day, zone)
+    end = local_midnight_ts(local_day + datetime.timedelta(days=1), zone)
+    key = local_day.strftime("%Y%m%d")
+    _tz_days[tz] = (start, end, key)
+    return key
+
+
+def next_local_time_ts(tz, hour, minute, now_ts=None):
+    """
+    Ближайший момент (UTC ts) строго после now_ts, когда в зоне tz будет hour:minute.
+    """
+    if now_ts is None:
+        now_ts = time.time()
+    zone = resolve_tz(tz) or resolve_tz(DEFAULT_TZ)
+    local_day = datetime.datetime.fromtimestamp(now_ts, zone).date()
+    for shift in range(3):
+        day = local_day + datetime.timedelta(days=shift)
+        ts = datetime.datetime.combine(day, datetime.time(hour, minute), tzinfo=zone).timestamp()
+        if ts > now_ts:
+            return ts
+    return now_ts + 86400
+
+
+# ================================
+# PROFILE STORAGE & CALC
+# ================================
+
+
+def get_profile(user_id):
+    res = supabase_select("profiles", {"user_id": f"eq.{user_id}"})
+    return res[0] if res else None
+
+
+def save_profile(user_id, new_data):
+    existing = get_profile(user_id) or {}
+    merged = dict(existing)
+    merged.update(new_data)
+    merged["user_id"] = user_id
+    merged["updated_at"] = datetime.datetime.utcnow().isoformat()
+    new_weight = new_data.get("weight")
+    # тот же вес тоже засеивает тренд, если профиль заведён ещё до ряда
+    if new_weight is not None and (new_weight != existing.get("weight") or existing.get("weight_trend") is None):
+        merged.update(record_weight(user_id, float(new_weight), existing))
+    supabase_upsert("profiles", merged)
+    return merged
+
+
+# ================================
+# WEIGHT TREND
+# ================================
+
+# Постоянная сглаживания тренда веса, дни: шум воды/соли гасится за ~1–2 недели
+WEIGHT_TREND_TAU_DAYS = float(os.environ.get("WEIGHT_TREND_TAU_DAYS", "10"))
+
+
+def weight_trend_step(state, weight, ts):
+    """
+    Один шаг экспоненциального сглаживания с учётом интервала между замерами.
+    state — поля профиля weight_trend/weight_rate/weight_ts/weight_points;
+    O(1) на новую точку, история не перечитывается. Возвращает новое состояние.
+    """
+    if state.get("weight_trend") is None or state.get("weight_ts") is None:
+        return {"weight_trend": weight, "weight_rate": 0.0, "weight_ts": ts, "weight_points": 1}
+
+    dt_days = max((ts - float(state["weight_ts"])) / 86400, 1e-6)
+    alpha = 1 - math.exp(-dt_days / WEIGHT_TREND_TAU_DAYS)
+    trend = float(state["weight_trend"])
+    new_trend = trend + alpha * (weight - trend)
+    slope_week = (new_trend - trend) / dt_days * 7
+    rate = float(state.get("weight_rate") or 0.0)
+    return {
+        "weight_trend": round(new_trend, 3),
+        "weight_rate": round(rate + alpha * (slope_week - rate), 4),
+        "weight_ts": ts,
+        "weight_points": int(state.get("weight_points") or 0) + 1,
+    }
+
+
+def record_weight(user_id, weight, profile):
+    """
+    Дописывает замер в weight_log и возвращает обновлённое состояние тренда для профиля.
+    """
+    ts = time.time()
+    state = profile or {}
+    if state.get("weight_trend") is None and state.get("weight") is not None:
+        # профиль из анкеты ещё без тренда: старый вес — первая точка ряда
+        try:
+            seed_ts = datetime.datetime.fromisoformat(state["updated_at"]).replace(
+                tzinfo=datetime.timezone.utc).timestamp()
+        except Exception:
+            seed_ts = ts - 86400
+        state = weight_trend_step({}, float(state["weight"]), min(seed_ts, ts))
+    supabase_insert("weight_log", {
+        "user_id": user_id,
+        "ts": datetime.datetime.utcfromtimestamp(ts).isoformat(),
+        "weight": round(weight, 1),
+    })
+    return weight_trend_step(state, weight, ts)
+
+
+def parse_weight_update(text):
+    """
+    Одна строка «Вес 87» / «Weight 87.5 kg» / «Težina 88» -> 87.0; иначе None.
+    """
+    m = re.fullmatch(
+        r"(вес|weight|težina|tezina)\s*[:\-]?\s*(\d{2,3}(?:[.,]\d)?)\s*(кг|kg)?",
+        text.lower().strip(),
+    )
+    if not m:
+        return None
+    weight = float(m.group(2).replace(",", "."))
+    return weight if 30 <= weight <= 300 else None
+
+
+def profile_tz(profile):
+    tz = (profile or {}).get("tz")
+    return tz if tz and resolve_tz(tz) else DEFAULT_TZ
+
+
+def get_today_key(tz=None):
+    return tz_day_key(tz or DEFAULT_TZ)
+
+
+# Итог за день в памяти: user_id -> (day, total_kcal).
+# /status и приёмы пищи читают его без похода в БД; со сменой дня итог начинается с нуля.
+# Кэш рассчитан на один процесс на бота (см. README): итог из кэша пишется в diary_days
+# целиком, и соседний воркер со своим кэшем затрёт чужой приём. Поэтому по умолчанию выключен.
+DIARY_CACHE_ENABLED = os.environ.get("DIARY_CACHE_ENABLED", "0") == "1"
+DIARY_CACHE_SIZE = int(os.environ.get("DIARY_CACHE_SIZE", "50000"))
+
+_diary_cache = OrderedDict()
+_diary_lock = threading.Lock()
+
+
+def _diary_cache_get(user_id, day):
+    if not DIARY_CACHE_ENABLED:
+        return None
+    user_id = tenant_key(user_id)
+    with _diary_lock:
+        entry = _diary_cache.get(user_id)
+        if entry is None:
+            return None
+        cached_day, total = entry
+        if cached_day > day:
+            # запрос за прошлый день — это не сегодняшний итог
+            return None
+        if cached_day < day:
+            total = 0
+            _diary_cache[user_id] = (day, total)
+        _diary_cache.move_to_end(user_id)
+        return total
+
+
+def _diary_cache_set(user_id, day, total):
+    if not DIARY_CACHE_ENABLED:
+        return
+    user_id = tenant_key(user_id)
+    with _diary_lock:
+        _diary_cache[user_id] = (day, total)
+        _diary_cache.move_to_end(user_id)
+        while len(_diary_cache) > DIARY_CACHE_SIZE:
+            _diary_cache.popitem(last=False)
+
+
+def diary_cache_drop(user_id):
+    """
+    Забыть итог пользователя: следующее чтение возьмёт его из Supabase.
+    """
+    with _diary_lock:
+        _diary_cache.pop(tenant_key(user_id), None)
+
+
+def diary_cache_prune(before_day):
+    """
+    Выкидываем записи за дни раньше before_day (вызывается на границе дня, раз на зону).
+    """
+    with _diary_lock:
+        stale = [uid for uid, (day, _) in _diary_cache.items() if day < before_day]
+        for uid in stale:
+            del _diary_cache[uid]
+    return len(stale)
+
+
+def get_day_total(user_id, day):
+    """
+    Итог дня или None, если его не удалось прочитать. Неудачное чтение не кэшируем:
+    иначе «0» прожил бы до конца дня и следующий приём затёр бы настоящий итог.
+    """
+    cached = _diary_cache_get(user_id, day)
+    if cached is not None:
+        return cached
+    try:
+        res = supabase_select("diary_days", {"user_id": f"eq.{user_id}", "day": f"eq.{day}"}, strict=True)
+    except Exception as e:
+        print("get_day_total error:", e)
+        return None
+    total = (res[0].get("total_kcal") or 0) if res else 0
+    _diary_cache_set(user_id, day, total)
+    return total
+
+
+def get_diary(user_id, day):
+    """
+    Только чтение: строку в diary_days создаёт первый приём пищи за день.
+    """
+    return {"user_id": user_id, "day": day, "total_kcal": get_day_total(user_id, day)}
+
+
+def update_diary_kcal(user_id, day, delta_kcal):
+    """
+    Новый итог дня или None, если текущий прочитать не вышло — тогда ничего не пишем.
+    """
+    total = get_day_total(user_id, day)
+    if total is None:
+        return None
+    new_total = total + delta_kcal
+    supabase_upsert("diary_days", {
+        "user_id": user_id,
+        "day": day,
+        "total_kcal": new_total,
+    })
+    _diary_cache_set(user_id, day, new_total)
+    return new_total
+
+
+def reset_diary_today(user_id, tz=None):
+    day = get_today_key(tz)
+    if _diary_cache_get(user_id, day) == 0:
+        # за сегодня ещё ничего нет — писать нечего
+        return
+    supabase_upsert("diary_days", {
+        "user_id": user_id,
+        "day": day,
+        "total_kcal": 0,
+    })
+    _diary_cache_set(user_id, day, 0)
+
+
+def add_meal_record(user_id, day, meal_number, desc, kcal, items=None):
+    supabase_insert("meals", {
+        "user_id": user_id,
+        "day": day,
+        "meal_number": meal_number,
+        "description": desc,
+        "kcal": kcal,
+    })
+    if items:
+        # разбор по продуктам — отдельными строками, одним запросом на весь приём
+        supabase_insert("meal_items", [
+            {
+                "user_id": user_id,
+                "day": day,
+                "meal_number": meal_number,
+                "position": position,
+                "name": it["name"],
+                "kcal": it["kcal"],
+            }
+            for position, it in enumerate(items, start=1)
+        ])
+
+
+def parse_profile(text):
+    """
+    Парсим профиль из свободного текста без обязательных двоеточий.
+    Формат: строки с ключевыми словами + число.
+    """
+    t = text.lower()
+
+    def find_int(labels):
+        pattern = r"(" + "|".join([re.escape(l) for l in labels]) + r")\s*[:\-]?\s*(\d+)"
+        m = re.search(pattern, t)
+        if not m:
+            return None
+        return int(m.group(2))
+
+    age = find_int(["возраст", "age", "godine"])
+    height = find_int(["рост", "height", "visina"])
     weight = find_int(["вес", "weight", "težina", "tezina"])
     goal = find_int(["цель вес", "цель", "goal weight", "goal", "ciljna težina", "ciljna tezina"])
 
@@ -623,16 +2019,105 @@ def parse_profile(text):
     return None
 
 
-def calc_target_kcal(profile):
-    if not profile:
-        return 2000
+PROFILE_ESSENTIAL_KEYS = ["age", "height", "weight", "goal", "activity_factor", "sex"]
+
+
+def is_full_profile(profile):
+    return bool(profile and all(profile.get(k) is not None for k in PROFILE_ESSENTIAL_KEYS))
+
+
+DEFAULT_TARGET_KCAL = 2000
+TARGET_DEFICIT_FACTOR = 0.8
+# Примерная энергия 1 кг массы тела (жир + вода), ккал
+KCAL_PER_KG = 7700
+FORECAST_WINDOW_DAYS = 28
+FORECAST_MIN_DAYS = 3
+
+
+def calc_tdee(profile):
     if profile.get("sex") == "m":
         bmr = 10 * profile["weight"] + 6.25 * profile["height"] - 5 * profile["age"] + 5
     else:
         bmr = 10 * profile["weight"] + 6.25 * profile["height"] - 5 * profile["age"] - 161
-    tdee = bmr * profile["activity_factor"]
-    deficit = tdee * 0.8
-    return round(deficit)
+    return bmr * profile["activity_factor"]
+
+
+@lru_cache(maxsize=4096)
+def _target_kcal(sex, weight, height, age, activity_factor):
+    profile = {"sex": sex, "weight": weight, "height": height, "age": age, "activity_factor": activity_factor}
+    return round(calc_tdee(profile) * TARGET_DEFICIT_FACTOR)
+
+
+def target_weight(profile):
+    """
+    Норма считается от сглаженного тренда веса, если он есть: разовые скачки
+    на воде не дёргают норму, а устойчивое изменение веса её пересчитывает.
+    """
+    trend = profile.get("weight_trend")
+    return round(float(trend), 1) if trend is not None else profile["weight"]
+
+
+def calc_target_kcal(profile):
+    if not profile:
+        return DEFAULT_TARGET_KCAL
+    # /status и каждый приём пересчитывают норму — для тех же данных берём из кэша
+    return _target_kcal(
+        profile.get("sex"), target_weight(profile), profile["height"], profile["age"], profile["activity_factor"],
+    )
+
+
+def calc_target_kcal_bulk(profiles):
+    """
+    Нормы для списка профилей одним векторным проходом (numpy).
+    Незаполненные профили получают DEFAULT_TARGET_KCAL, как в calc_target_kcal.
+    Возвращает numpy-массив int той же длины.
+    """
+    import numpy as np
+
+    n = len(profiles)
+    full = np.fromiter((is_full_profile(p) for p in profiles), dtype=bool, count=n)
+
+    def column(key):
+        return np.fromiter(((p.get(key) or 0) if p else 0 for p in profiles), dtype=float, count=n)
+
+    is_male = np.fromiter(((p or {}).get("sex") == "m" for p in profiles), dtype=bool, count=n)
+    weight = np.fromiter((target_weight(p) if full[i] else 0 for i, p in enumerate(profiles)), dtype=float, count=n)
+    bmr = 10 * weight + 6.25 * column("height") - 5 * column("age") + np.where(is_male, 5, -161)
+    targets = np.round(bmr * column("activity_factor") * TARGET_DEFICIT_FACTOR).astype(int)
+    return np.where(full, targets, DEFAULT_TARGET_KCAL)
+
+
+def forecast_weight(profile, diary_rows, today):
+    """
+    Прогноз по дневнику: средний баланс (съедено − расход) по залогированным дням
+    за прошлые дни -> изменение веса в неделю и дата достижения цели.
+    Весь ряд считается одним векторным проходом. None — если данных мало.
+    """
+    import numpy as np
+
+    rows = [r for r in diary_rows if r.get("day") != today and (r.get("total_kcal") or 0) > 0]
+    if len(rows) < FORECAST_MIN_DAYS:
+        return None
+
+    intake = np.fromiter((r["total_kcal"] for r in rows), dtype=float, count=len(rows))
+    balance = intake - calc_tdee(profile)
+    kg_per_day = float(balance.mean()) / KCAL_PER_KG
+
+    weight = float(profile["weight"])
+    goal = float(profile["goal"])
+    to_goal = goal - weight
+    days_to_goal = None
+    if to_goal != 0 and kg_per_day != 0 and np.sign(to_goal) == np.sign(kg_per_day):
+        days_to_goal = int(np.ceil(to_goal / kg_per_day))
+
+    return {
+        "days": len(rows),
+        "avg_intake": int(round(intake.mean())),
+        "avg_balance": int(round(balance.mean())),
+        "kg_per_week": round(kg_per_day * 7, 2),
+        "weight_30d": round(weight + kg_per_day * 30, 1),
+        "days_to_goal": days_to_goal,
+    }
 
 
 # ================================
@@ -672,6 +2157,43 @@ def looks_like_meal(text):
     return False
 
 
+# Один системный промпт на все языки и все вызовы: у бэкендов с prefix caching
+# он кэшируется целиком, а всё переменное (язык, описание) идёт после него.
+# Ответ в компактной схеме, expand_compact_analysis разворачивает её обратно.
+MEAL_SYSTEM_PROMPT = (
+    "You are a nutritionist. Estimate calories of ONE meal from its description.\n"
+    "Split it into items, estimate kcal of each portion as an integer, sum them.\n"
+    "Typical adult meal is 100-1500 kcal; exceed only if clearly a whole day or a binge.\n"
+    "If vague, give your best estimate. Never ask questions.\n"
+    "Reply with JSON only, no other text:\n"
+    "{\"i\":[[\"item\",kcal],...],\"t\":total_kcal,\"c\":\"note\"}\n"
+    "\"c\" is optional: a short note only if something matters. "
+    "Item names and note in the language given by Lang."
+)
+
+LANG_NAMES = {"ru": "Russian", "en": "English", "sr": "Serbian (Latin)"}
+
+
+def meal_user_prompt(user_text, lang):
+    return f"Lang: {LANG_NAMES.get(lang, LANG_NAMES['ru'])}\nMeal: {user_text}"
+
+
+def expand_compact_analysis(data):
+    """
+    {"i": [[name, kcal], ...], "t": total, "c": note} -> {"items", "total_kcal", "comment"}.
+    Полная схема проходит как есть.
+    """
+    if "i" not in data and "t" not in data:
+        return data
+    items = []
+    for it in data.get("i") or []:
+        if isinstance(it, (list, tuple)) and len(it) >= 2:
+            items.append({"name": it[0], "kcal": it[1]})
+        elif isinstance(it, dict):
+            items.append({"name": it.get("n") or it.get("name"), "kcal": it.get("k") or it.get("kcal")})
+    return {"items": items, "total_kcal": data.get("t"), "comment": data.get("c") or ""}
+
+
 def ai_meal_analysis(user_text, lang):
     """
     Отправляет описание еды в ИИ и возвращает структуру:
@@ -685,76 +2207,77 @@ def ai_meal_analysis(user_text, lang):
     if lang not in TEXT:
         lang = "ru"
 
-    if lang == "ru":
-        system_prompt = (
-            "Ты нутриционист. По описанию приёма пищи оцени калории.\n"
-            "1) Разбей текст на конкретные элементы (блюда/продукты).\n"
-            "2) Для каждого элемента оцени калории (kcal) для указанной порции.\n"
-            "3) Посчитай итоговую сумму калорий для этого приёма пищи.\n"
-            "4) Используй реалистичные значения: обычный приём пищи взрослого человека "
-            "обычно в диапазоне 100–1500 ккал. Если явно описан целый день или очень много еды/алкоголя, "
-            "сумма может быть выше, но старайся не завышать без причины.\n"
-            "5) Если информации мало или всё очень примерное — сделай лучшую оценку, "
-            "НЕ задавай уточняющих вопросов.\n\n"
-            "Ответ верни строго в формате JSON:\n"
-            "{\n"
-            "  \"items\": [\n"
-            "    {\"name\": \"описание элемента\", \"kcal\": число},\n"
-            "    ...\n"
-            "  ],\n"
-            "  \"total_kcal\": число,\n"
-            "  \"comment\": \"краткое пояснение на русском\"\n"
-            "}\n"
-            "Без лишнего текста вне JSON."
-        )
-    elif lang == "en":
-        system_prompt = (
-            "You are a nutritionist. Given a meal description, estimate calories.\n"
-            "1) Split it into specific items.\n"
-            "2) For each item, estimate kcal for the given portion.\n"
-            "3) Compute total kcal for this meal.\n"
-            "4) Use realistic values: a typical adult meal is ~100–1500 kcal. "
-            "If clearly described as a full day or huge binge, it can be higher, "
-            "but avoid unreasonable overestimates.\n"
-            "5) If information is approximate, still give your best estimate, "
-            "do NOT ask follow-up questions.\n\n"
-            "Return STRICT JSON only:\n"
-            "{\n"
-            "  \"items\": [\n"
-            "    {\"name\": \"item description\", \"kcal\": number},\n"
-            "    ...\n"
-            "  ],\n"
-            "  \"total_kcal\": number,\n"
-            "  \"comment\": \"short explanation in English\"\n"
-            "}"
-        )
-    else:  # sr
-        system_prompt = (
-            "Ti si nutricionista. Na osnovu opisa obroka proceni kalorije.\n"
-            "1) Podeli opis na konkretne stavke.\n"
-            "2) Za svaku stavku proceni kalorije (kcal) za celu porciju.\n"
-            "3) Izračunaj ukupne kalorije za ovaj obrok.\n"
-            "4) Koristi realne vrednosti: tipičan obrok odrasle osobe je oko 100–1500 kcal. "
-            "Ako je jasno da je opisan ceo dan ili ekstremno mnogo hrane/alkohola, "
-            "ukupno može biti više, ali izbegavaj preterivanje.\n"
-            "5) Ako je opis približan, ipak daj najbolju procenu, BEZ dodatnih pitanja.\n\n"
-            "Vrati STROGO JSON:\n"
-            "{\n"
-            "  \"items\": [\n"
-            "    {\"name\": \"opis stavke\", \"kcal\": broj},\n"
-            "    ...\n"
-            "  ],\n"
-            "  \"total_kcal\": broj,\n"
-            "  \"comment\": \"kratko objašnjenje na srpskom\"\n"
-            "}"
-        )
+    system_prompt = MEAL_SYSTEM_PROMPT
+    user_prompt = meal_user_prompt(user_text, lang)
+
+    route = route_meal(user_text)
+    analysis = run_meal_route(route, system_prompt, user_prompt)
+    if analysis is None and route != "remote":
+        metrics.incr(f"llm.{route}.fallback")
+        return run_meal_route("remote", system_prompt, user_prompt)
+
+    if analysis is not None and route != "remote" and random.random() < ROUTER_SHADOW_RATE:
+        submit_in_context(_shadow_pool, shadow_compare, route, system_prompt, user_prompt, analysis)
+    return analysis
+
+
+# Маршрутизация: короткие простые приёмы — локальной модели, сложные — удалённой
+ROUTER_MAX_SIMPLE_ITEMS = int(os.environ.get("ROUTER_MAX_SIMPLE_ITEMS", "2"))
+ROUTER_MAX_SIMPLE_CHARS = int(os.environ.get("ROUTER_MAX_SIMPLE_CHARS", "60"))
+# Доля «локальных» приёмов, которые дополнительно считает удалённая модель для оценки точности
+ROUTER_SHADOW_RATE = float(os.environ.get("ROUTER_SHADOW_RATE", "0.05"))
 
-    user_prompt = f"Opis obroka / meal description:\n{user_text}\n\nVrati только JSON."
+_shadow_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
 
-    raw = call_hf_chat(system_prompt, user_prompt, response_format_json=True)
+
+def meal_complexity(text):
+    """
+    Грубая оценка сложности: число перечисленных позиций и длина текста.
+    """
+    t = text.lower().strip()
+    parts = [p for p in re.split(r"[,;\n+]|\s(?:и|с|and|with|i|sa)\s", t) if p.strip()]
+    return len(parts), len(t)
+
+
+def route_meal(text):
+    if not local_backend.available():
+        return "remote"
+    items, length = meal_complexity(text)
+    if items <= ROUTER_MAX_SIMPLE_ITEMS and length <= ROUTER_MAX_SIMPLE_CHARS:
+        return "local"
+    return "remote"
+
+
+def run_meal_route(route, system_prompt, user_prompt):
+    started = time.monotonic()
+    raw = get_backend(route).chat(system_prompt, user_prompt, response_format_json=True)
+    metrics.observe(f"llm.{route}.latency_s", time.monotonic() - started)
+    metrics.incr(f"llm.{route}.calls")
     if raw is None:
+        metrics.incr(f"llm.{route}.errors")
         return None
+    analysis = normalize_meal_analysis(raw)
+    if analysis is None:
+        metrics.incr(f"llm.{route}.parse_failed")
+    return analysis
 
+
+def shadow_compare(route, system_prompt, user_prompt, analysis):
+    """
+    Точность маршрута: относительное расхождение итоговых ккал с удалённой моделью.
+    """
+    reference = run_meal_route("remote", system_prompt, user_prompt)
+    if not reference:
+        return
+    error = abs(analysis["total_kcal"] - reference["total_kcal"]) / reference["total_kcal"]
+    metrics.observe(f"llm.{route}.abs_pct_error", error * 100)
+
+
+def normalize_meal_analysis(raw):
+    """
+    Разбирает ответ модели (строка с JSON или dict) в
+    {"items": [...], "total_kcal": int, "comment": str} либо None.
+    """
     data = None
     if isinstance(raw, dict):
         data = raw
@@ -774,6 +2297,7 @@ def ai_meal_analysis(user_text, lang):
         print("AI JSON parse failed, raw:", raw)
         return None
 
+    data = expand_compact_analysis(data)
     items = data.get("items") or []
     total = data.get("total_kcal")
 
@@ -815,13 +2339,881 @@ def ai_meal_analysis(user_text, lang):
 
 def send_message(chat_id, text):
     try:
-        requests.post(
-            f"{TELEGRAM_API}/sendMessage",
+        return http().post(
+            f"{current_tenant().telegram_api}/sendMessage",
             json={"chat_id": chat_id, "text": text},
             timeout=10,
         )
     except Exception as e:
         print("send_message error:", e)
+        return None
+
+
+# Лимиты Telegram для рассылок: ~30 сообщений/с на бота и 1 сообщение/с в один чат
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "30"))
+SEND_PER_CHAT_INTERVAL = float(os.environ.get("SEND_PER_CHAT_INTERVAL", "1"))
+SEND_CONCURRENCY = int(os.environ.get("SEND_CONCURRENCY", "8"))
+SEND_MAX_RETRIES = 3
+
+
+class RateLimiter:
+    """
+    Token bucket: acquire() блокирует, пока не появится токен.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BulkSender:
+    """
+    Параллельная отправка рассылок с глобальным лимитом и паузой между сообщениями в один чат.
+    На 429 ждём retry_after из ответа Telegram и повторяем.
+    """
+
+    def __init__(self, rate=SEND_GLOBAL_RATE, per_chat_interval=SEND_PER_CHAT_INTERVAL,
+                 concurrency=SEND_CONCURRENCY):
+        self.limiter = RateLimiter(rate)
+        self.per_chat_interval = per_chat_interval
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="sender")
+        self.chat_next = {}
+        self.chat_lock = threading.Lock()
+
+    def _wait_chat_slot(self, chat_id):
+        with self.chat_lock:
+            now = time.monotonic()
+            slot = max(now, self.chat_next.get(chat_id, 0))
+            self.chat_next[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def send(self, chat_id, text):
+        for _ in range(SEND_MAX_RETRIES):
+            self._wait_chat_slot(chat_id)
+            self.limiter.acquire()
+            r = send_message(chat_id, text)
+            if r is None:
+                continue
+            if r.status_code == 429:
+                try:
+                    retry_after = r.json().get("parameters", {}).get("retry_after", 1)
+                except Exception:
+                    retry_after = 1
+                time.sleep(retry_after)
+                continue
+            return r.status_code == 200
+        return False
+
+    def send_many(self, messages):
+        """
+        messages: [(chat_id, text), ...]. Ждёт отправки всех, возвращает число успешных.
+        """
+        futures = [submit_in_context(self.pool, self.send, chat_id, text) for chat_id, text in messages]
+        sent = sum(1 for f in futures if f.result())
+        with self.chat_lock:
+            # чистим давно прошедшие слоты, чтобы словарь не рос бесконечно
+            now = time.monotonic()
+            self.chat_next = {c: t for c, t in self.chat_next.items() if t > now}
+        return sent
+
+
+def telegram_file_path(file_id):
+    try:
+        r = http().get(f"{current_tenant().telegram_api}/getFile", params={"file_id": file_id}, timeout=10)
+        data = r.json()
+        if data.get("ok"):
+            return data["result"].get("file_path")
+    except Exception as e:
+        print("getFile error:", e)
+    return None
+
+
+def telegram_download(file_id, max_bytes):
+    """
+    Потоковая загрузка файла из Telegram кусками; больше max_bytes — не качаем.
+    """
+    file_path = telegram_file_path(file_id)
+    if not file_path:
+        return None
+    try:
+        with http().get(f"{current_tenant().telegram_file_api}/{file_path}", stream=True, timeout=20) as r:
+            if r.status_code != 200:
+                print("file download NON-200:", r.status_code)
+                return None
+            buf = bytearray()
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                buf.extend(chunk)
+                if len(buf) > max_bytes:
+                    print("file download too large:", file_path)
+                    return None
+            return bytes(buf)
+    except Exception as e:
+        print("file download error:", e)
+        return None
+
+
+# ================================
+# PHOTO MEALS
+# ================================
+
+PHOTO_MAX_DOWNLOAD_BYTES = int(os.environ.get("PHOTO_MAX_DOWNLOAD_BYTES", str(5 * 1024 * 1024)))
+PHOTO_MAX_UPLOAD_BYTES = int(os.environ.get("PHOTO_MAX_UPLOAD_BYTES", str(300 * 1024)))
+PHOTO_MAX_SIDE = int(os.environ.get("PHOTO_MAX_SIDE", "1024"))
+PHOTO_DECODE_WORKERS = int(os.environ.get("PHOTO_DECODE_WORKERS", "2"))
+# Сколько фото одновременно может быть в работе (загрузка + декодирование + запрос к модели)
+PHOTO_MAX_INFLIGHT = int(os.environ.get("PHOTO_MAX_INFLIGHT", "4"))
+
+_photo_pool = ThreadPoolExecutor(max_workers=PHOTO_DECODE_WORKERS, thread_name_prefix="photo")
+_photo_slots = threading.BoundedSemaphore(PHOTO_MAX_INFLIGHT)
+# Фото обрабатывается целиком в фоне: веб-воркер отвечает Telegram сразу
+_photo_meal_pool = ThreadPoolExecutor(max_workers=PHOTO_MAX_INFLIGHT, thread_name_prefix="photo-meal")
+
+
+def pick_photo_size(sizes):
+    """
+    Самый крупный вариант из msg["photo"], который помещается в лимит загрузки.
+    """
+    fitting = [p for p in sizes if (p.get("file_size") or 0) <= PHOTO_MAX_DOWNLOAD_BYTES]
+    candidates = fitting or sizes
+    if not candidates:
+        return None
+    return max(candidates, key=lambda p: (p.get("width") or 0) * (p.get("height") or 0))
+
+
+def shrink_image(data):
+    """
+    Уменьшаем до PHOTO_MAX_SIDE и пережимаем в JPEG, пока не влезем в PHOTO_MAX_UPLOAD_BYTES.
+    Pillow декодирует и ресайзит без GIL, поэтому хватает пула потоков.
+    """
+    import io
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        # для JPEG draft() декодирует сразу в уменьшенном масштабе — меньше памяти и CPU
+        img.draft("RGB", (PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+        img = img.convert("RGB")
+        img.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+        out = b""
+        for quality in (85, 75, 60, 45):
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG", quality=quality, optimize=True)
+            out = buf.getvalue()
+            if len(out) <= PHOTO_MAX_UPLOAD_BYTES:
+                break
+        return out
+
+
+def ai_photo_meal_analysis(sizes, caption, lang):
+    """
+    Фото еды -> та же структура, что у ai_meal_analysis, или None.
+    Блокирует на загрузку, декодирование и запрос к модели, поэтому
+    вызывается только из фонового handle_photo.
+    """
+    if lang not in TEXT:
+        lang = "ru"
+    size = pick_photo_size(sizes)
+    if not size:
+        return None
+    data = telegram_download(size["file_id"], PHOTO_MAX_DOWNLOAD_BYTES)
+    if not data:
+        return None
+    try:
+        image = _photo_pool.submit(shrink_image, data).result(timeout=30)
+    except Exception as e:
+        print("photo processing error:", e)
+        return None
+    del data
+
+    user_prompt = meal_user_prompt(caption or "see photo, estimate every visible item", lang)
+    raw = call_vision_chat(MEAL_SYSTEM_PROMPT, user_prompt, image)
+    if raw is None:
+        return None
+    return normalize_meal_analysis(raw)
+
+
+def handle_photo(chat_id, profile, lang, tz, sizes, caption):
+    T = texts(lang)
+    try:
+        analysis = ai_photo_meal_analysis(sizes, caption, lang)
+        if not analysis:
+            send_message(chat_id, T["cannot_parse_photo"])
+            return
+        log_meal_and_reply(chat_id, profile, lang, tz, caption or "📷", analysis, remember=False)
+    except Exception as e:
+        print("photo handling error:", e)
+    finally:
+        _photo_slots.release()
+
+
+def submit_photo(chat_id, profile, lang, tz, sizes, caption):
+    """
+    Ставит фото в фоновую обработку (загрузка + разбор + ответ).
+    Возвращает "busy", если в работе уже PHOTO_MAX_INFLIGHT фото, иначе None.
+    """
+    if not _photo_slots.acquire(blocking=False):
+        metrics.incr("photo.rejected")
+        return "busy"
+    try:
+        submit_in_context(_photo_meal_pool, handle_photo, chat_id, profile, lang, tz, sizes, caption)
+    except Exception:
+        _photo_slots.release()
+        raise
+    return None
+
+
+# ================================
+# VOICE MEALS
+# ================================
+
+# Локальная модель faster-whisper (tiny/base/small/...); пусто — голосовые не принимаем
+STT_MODEL = os.environ.get("STT_MODEL")
+STT_WORKERS = int(os.environ.get("STT_WORKERS", "1"))
+STT_CPU_THREADS = int(os.environ.get("STT_CPU_THREADS", "2"))
+# Сколько голосовых может ждать/распознаваться одновременно; остальным — «занят»
+VOICE_MAX_QUEUE = int(os.environ.get("VOICE_MAX_QUEUE", "4"))
+VOICE_MAX_SECONDS = int(os.environ.get("VOICE_MAX_SECONDS", "120"))
+VOICE_MAX_DOWNLOAD_BYTES = int(os.environ.get("VOICE_MAX_DOWNLOAD_BYTES", str(2 * 1024 * 1024)))
+
+_stt_pool = None
+_stt_pool_lock = threading.Lock()
+_voice_slots = threading.BoundedSemaphore(VOICE_MAX_QUEUE)
+# Голосовое обрабатывается целиком в фоне: веб-воркер отвечает Telegram сразу
+_voice_pool = ThreadPoolExecutor(max_workers=VOICE_MAX_QUEUE, thread_name_prefix="voice")
+
+
+def get_stt_pool():
+    """
+    Пул процессов: распознавание грузит CPU и не должно отнимать GIL у текстовых апдейтов.
+    spawn — чтобы не форкать процесс с потоками и открытыми соединениями.
+    """
+    global _stt_pool
+    if _stt_pool is None:
+        with _stt_pool_lock:
+            if _stt_pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                import stt_worker
+
+                _stt_pool = ProcessPoolExecutor(
+                    max_workers=STT_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=stt_worker.init_worker,
+                    initargs=(STT_MODEL, STT_CPU_THREADS),
+                )
+    return _stt_pool
+
+
+def transcribe_voice(voice, lang):
+    """
+    Голосовое (voice из апдейта) -> текст или None. Блокирует до конца распознавания,
+    поэтому вызывается только из фонового handle_voice.
+    """
+    try:
+        data = telegram_download(voice["file_id"], VOICE_MAX_DOWNLOAD_BYTES)
+        if not data:
+            return None
+        import stt_worker
+
+        future = get_stt_pool().submit(stt_worker.transcribe, data, time.time(), lang)
+        del data
+        text, queue_wait, latency = future.result(timeout=VOICE_MAX_SECONDS * 2)
+        metrics.observe("stt.queue_wait_s", queue_wait)
+        metrics.observe("stt.latency_s", latency)
+        metrics.incr("stt.transcribed")
+        return text or None
+    except Exception as e:
+        metrics.incr("stt.errors")
+        print("voice transcription error:", e)
+        return None
+
+
+def handle_voice(chat_id, profile, lang, tz, voice):
+    T = texts(lang)
+    try:
+        transcript = transcribe_voice(voice, lang)
+        if not transcript:
+            send_message(chat_id, T["cannot_parse_voice"])
+            return
+        send_message(chat_id, T["voice_heard"].format(text=transcript))
+        handle_meal_text(chat_id, profile, lang, tz, transcript)
+    except Exception as e:
+        print("voice handling error:", e)
+    finally:
+        _voice_slots.release()
+
+
+def submit_voice(chat_id, profile, lang, tz, voice):
+    """
+    Ставит голосовое в фоновую обработку (распознавание + разбор + ответ).
+    Возвращает "busy", "rejected" (нет модели / слишком длинное) или None, если принято.
+    """
+    if not STT_MODEL:
+        print("STT config missing")
+        return "rejected"
+    if (voice.get("duration") or 0) > VOICE_MAX_SECONDS:
+        return "rejected"
+    if not _voice_slots.acquire(blocking=False):
+        metrics.incr("stt.rejected")
+        return "busy"
+    try:
+        submit_in_context(_voice_pool, handle_voice, chat_id, profile, lang, tz, voice)
+    except Exception:
+        _voice_slots.release()
+        raise
+    return None
+
+
+# ================================
+# SCHEDULER (TIMER WHEEL)
+# ================================
+
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "0") == "1"
+
+
+class TimerWheel:
+    """
+    Хешированное колесо таймеров: size слотов по tick секунд.
+    Добавление и срабатывание — O(1) на задачу, без кучи и без сортировки.
+    """
+
+    def __init__(self, tick=1.0, size=3600):
+        self.tick = tick
+        self.size = size
+        self.slots = [[] for _ in range(size)]
+        self.current = int(time.time() // tick)
+        self.lock = threading.Lock()
+
+    def schedule(self, when_ts, callback):
+        with self.lock:
+            due = max(int(-(-when_ts // self.tick)), self.current + 1)
+            self.slots[due % self.size].append((due, callback))
+
+    def advance(self, now_ts=None):
+        if now_ts is None:
+            now_ts = time.time()
+        now_tick = int(now_ts // self.tick)
+        fired = []
+        with self.lock:
+            if now_tick <= self.current:
+                return 0
+            # после долгого простоя хватает одного оборота: там все просроченные задачи
+            steps = min(now_tick - self.current, self.size)
+            for i in range(steps):
+                slot_index = (now_tick - i) % self.size
+                slot = self.slots[slot_index]
+                if not slot:
+                    continue
+                keep = [entry for entry in slot if entry[0] > now_tick]
+                fired.extend(entry for entry in slot if entry[0] <= now_tick)
+                self.slots[slot_index] = keep
+            self.current = now_tick
+        for _, callback in sorted(fired, key=lambda entry: entry[0]):
+            try:
+                callback()
+            except Exception as e:
+                print("scheduler callback error:", e)
+        return len(fired)
+
+    def run(self, stop_event):
+        while not stop_event.wait(self.tick):
+            self.advance()
+
+
+class ZoneScheduler:
+    """
+    Ежедневные задачи по местному времени. Событие срабатывает один раз на зону,
+    а не на каждого пользователя: callback(tz, day_key).
+    """
+
+    def __init__(self, wheel):
+        self.wheel = wheel
+        self.jobs = []
+        self.zones = set()
+        self.lock = threading.Lock()
+
+    def add_daily_job(self, name, hour, minute, callback):
+        job = (name, hour, minute, callback)
+        with self.lock:
+            self.jobs.append(job)
+            zones = list(self.zones)
+        for tz in zones:
+            self._schedule(tz, job)
+
+    def add_zone(self, tz):
+        if tz in self.zones:
+            return
+        with self.lock:
+            if tz in self.zones:
+                return
+            self.zones.add(tz)
+            jobs = list(self.jobs)
+        for job in jobs:
+            self._schedule(tz, job)
+
+    def _schedule(self, tz, job, after_ts=None):
+        _, hour, minute, _ = job
+        when = next_local_time_ts(tz, hour, minute, after_ts)
+        self.wheel.schedule(when, lambda: self._fire(tz, job, when))
+
+    def _fire(self, tz, job, when):
+        name, _, _, callback = job
+        day = tz_day_key(tz, when)
+        try:
+            callback(tz, day)
+        except Exception as e:
+            print("scheduled job error:", name, tz, e)
+        self._schedule(tz, job, when)
+
+
+def on_day_boundary(tz, day):
+    # Самые дальние зоны расходятся не больше чем на двое суток
+    before = (datetime.datetime.strptime(day, "%Y%m%d") - datetime.timedelta(days=2)).strftime("%Y%m%d")
+    diary_cache_prune(before)
+
+
+wheel = TimerWheel()
+scheduler = ZoneScheduler(wheel)
+scheduler.add_daily_job("day_boundary", 0, 0, on_day_boundary)
+scheduler.add_zone(DEFAULT_TZ)
+
+_scheduler_stop = threading.Event()
+
+
+def start_scheduler():
+    t = threading.Thread(target=wheel.run, args=(_scheduler_stop,), name="scheduler", daemon=True)
+    t.start()
+    if DAILY_SUMMARY_ENABLED:
+        _broadcast_pool.submit(load_profile_zones)
+        _broadcast_pool.submit(resume_broadcasts)
+    return t
+
+
+# ================================
+# DAILY SUMMARY BROADCAST
+# ================================
+
+DAILY_SUMMARY_ENABLED = os.environ.get("DAILY_SUMMARY_ENABLED", "1") == "1"
+SUMMARY_HOUR = int(os.environ.get("SUMMARY_HOUR", "21"))
+SUMMARY_MINUTE = int(os.environ.get("SUMMARY_MINUTE", "0"))
+BROADCAST_CHECKPOINT_PATH = os.environ.get("BROADCAST_CHECKPOINT_PATH", "broadcast_checkpoints.json")
+CHECKPOINT_DONE = "*done*"
+
+# Рассылки идут по одной, чтобы не блокировать колесо таймеров и не делить лимит Telegram
+_broadcast_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="broadcast")
+_checkpoint_lock = threading.Lock()
+# Лимиты Telegram — на токен бота, поэтому у каждого арендатора свой отправитель
+_bulk_senders = {}
+
+
+def get_bulk_sender():
+    tenant_id = current_tenant().id
+    sender = _bulk_senders.get(tenant_id)
+    if sender is None:
+        sender = _bulk_senders.setdefault(tenant_id, BulkSender())
+    return sender
+
+
+def load_checkpoints():
+    try:
+        with open(BROADCAST_CHECKPOINT_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print("checkpoint read error:", e)
+        return {}
+
+
+def save_checkpoint(key, value):
+    """
+    Чекпоинт: job|tz|day -> последний обработанный user_id (или CHECKPOINT_DONE).
+    Пишем через временный файл + os.replace, чтобы падение не оставило битый JSON.
+    """
+    with _checkpoint_lock:
+        data = load_checkpoints()
+        data[key] = value
+        oldest = (datetime.datetime.utcnow() - datetime.timedelta(days=3)).strftime("%Y%m%d")
+        data = {k: v for k, v in data.items() if k.rsplit("|", 1)[-1] >= oldest}
+        tmp = BROADCAST_CHECKPOINT_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, BROADCAST_CHECKPOINT_PATH)
+
+
+def tz_bucket_filter(tz):
+    if tz == DEFAULT_TZ:
+        return {"or": f"(tz.is.null,tz.eq.{tz})"}
+    return {"tz": f"eq.{tz}"}
+
+
+def render_daily_summary(profile, total_kcal):
+    T = texts(profile.get("lang") or "ru")
+    if not total_kcal:
+        return T["evening_reminder"]
+    target = calc_target_kcal(profile)
+    return T["evening_summary"].format(
+        total_kcal=total_kcal,
+        target_kcal=target,
+        left_kcal=target - total_kcal,
+    )
+
+
+def run_daily_broadcast(tz, day):
+    """
+    Вечерняя сводка для всех пользователей зоны: профили страницами по user_id,
+    дневники страницы одним запросом in.(...), отправка через BulkSender.
+    После каждой страницы — чекпоинт; после падения продолжаем со следующей страницы.
+    """
+    key = f"summary|{current_tenant().id}|{tz}|{day}"
+    after = load_checkpoints().get(key)
+    if after == CHECKPOINT_DONE:
+        return 0
+
+    sender = get_bulk_sender()
+    sent = 0
+    try:
+        pages = supabase_select_keyset("profiles", tz_bucket_filter(tz), after=after)
+        for page in pages:
+            profiles = [p for p in page if is_full_profile(p)]
+            totals = {}
+            if profiles:
+                rows = supabase_select_in(
+                    "diary_days", "user_id", [p["user_id"] for p in profiles],
+                    {"day": f"eq.{day}"}, select="user_id,total_kcal",
+                )
+                totals = {str(row["user_id"]): row.get("total_kcal") or 0 for row in rows}
+            messages = [
+                (p["user_id"], render_daily_summary(p, totals.get(str(p["user_id"]))))
+                for p in profiles
+            ]
+            sent += sender.send_many(messages)
+            save_checkpoint(key, page[-1]["user_id"])
+    except Exception as e:
+        print("daily broadcast error:", tz, day, e)
+        return sent
+
+    save_checkpoint(key, CHECKPOINT_DONE)
+    print(f"daily broadcast {tz} {day}: sent {sent}")
+    return sent
+
+
+def run_daily_broadcast_all(tz, day):
+    for tenant in TENANTS.values():
+        with tenant_context(tenant):
+            run_daily_broadcast(tz, day)
+
+
+def resume_broadcasts():
+    for key, value in load_checkpoints().items():
+        parts = key.split("|")
+        if len(parts) != 4:
+            continue
+        job, tenant_id, tz, day = parts
+        tenant = TENANTS.get(tenant_id)
+        if job == "summary" and tenant and value != CHECKPOINT_DONE and day == tz_day_key(tz):
+            with tenant_context(tenant):
+                run_daily_broadcast(tz, day)
+
+
+def load_profile_zones():
+    for tenant in TENANTS.values():
+        with tenant_context(tenant):
+            try:
+                for page in supabase_select_keyset("profiles", {"tz": "not.is.null"}, select="user_id,tz"):
+                    for row in page:
+                        if resolve_tz(row["tz"]):
+                            scheduler.add_zone(row["tz"])
+            except Exception as e:
+                print("load_profile_zones error:", tenant.id, e)
+
+
+if DAILY_SUMMARY_ENABLED:
+    scheduler.add_daily_job(
+        "daily_summary", SUMMARY_HOUR, SUMMARY_MINUTE,
+        lambda tz, day: _broadcast_pool.submit(run_daily_broadcast_all, tz, day),
+    )
+
+
+# ================================
+# MEAL HISTORY (LOCAL INDEXED STORE)
+# ================================
+
+MEAL_STORE_PATH = os.environ.get("MEAL_STORE_PATH", "meal_store.sqlite3")
+HISTORY_LIMIT = 10
+# Какая доля триграмм запроса должна найтись в описании, чтобы считать его совпадением
+HISTORY_MIN_SIMILARITY = 0.5
+
+
+def normalize_meal_text(text):
+    return re.sub(r"\s+", " ", text.lower()).strip(" .,!;:")
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i: i + 3] for i in range(len(padded) - 2)}
+
+
+class MealStore:
+    """
+    Локальная история приёмов пищи на SQLite: одно описание = одна строка
+    (с разбором и ккал), плюс триграммный индекс для нечёткого поиска.
+    Префиксный поиск — диапазон по индексу (user_id, desc_norm), без LIKE.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meal_history (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                desc_norm TEXT NOT NULL,
+                description TEXT NOT NULL,
+                items TEXT NOT NULL,
+                kcal INTEGER NOT NULL,
+                tri_count INTEGER NOT NULL,
+                times INTEGER NOT NULL DEFAULT 1,
+                last_used REAL NOT NULL,
+                UNIQUE (user_id, desc_norm)
+            );
+            CREATE INDEX IF NOT EXISTS meal_history_recent ON meal_history (user_id, last_used);
+            CREATE TABLE IF NOT EXISTS meal_trigrams (
+                user_id TEXT NOT NULL,
+                tri TEXT NOT NULL,
+                meal_id INTEGER NOT NULL,
+                PRIMARY KEY (user_id, tri, meal_id)
+            ) WITHOUT ROWID;
+        """)
+
+    @staticmethod
+    def _row(row):
+        if not row:
+            return None
+        meal_id, description, items, kcal, times = row
+        return {"id": meal_id, "description": description, "items": json.loads(items),
+                "kcal": kcal, "times": times}
+
+    def remember(self, user_id, description, items, kcal):
+        norm = normalize_meal_text(description)
+        if not norm:
+            return
+        tris = trigrams(norm)
+        with self.lock, self.db:
+            cur = self.db.execute(
+                "UPDATE meal_history SET items = ?, kcal = ?, times = times + 1, last_used = ? "
+                "WHERE user_id = ? AND desc_norm = ?",
+                (json.dumps(items, ensure_ascii=False), kcal, time.time(), user_id, norm),
+            )
+            if cur.rowcount:
+                return
+            cur = self.db.execute(
+                "INSERT INTO meal_history (user_id, desc_norm, description, items, kcal, tri_count, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, norm, description, json.dumps(items, ensure_ascii=False), kcal, len(tris), time.time()),
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO meal_trigrams (user_id, tri, meal_id) VALUES (?, ?, ?)",
+                [(user_id, tri, cur.lastrowid) for tri in tris],
+            )
+
+    def exact(self, user_id, description):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, description, items, kcal, times FROM meal_history "
+                "WHERE user_id = ? AND desc_norm = ?",
+                (user_id, normalize_meal_text(description)),
+            ).fetchone()
+        return self._row(row)
+
+    def get(self, user_id, meal_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, description, items, kcal, times FROM meal_history WHERE user_id = ? AND id = ?",
+                (user_id, meal_id),
+            ).fetchone()
+        return self._row(row)
+
+    def recent(self, user_id, limit=HISTORY_LIMIT):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, description, items, kcal, times FROM meal_history "
+                "WHERE user_id = ? ORDER BY last_used DESC LIMIT ?",
+                (user_id, limit),
+            ).fetchall()
+        return [self._row(r) for r in rows]
+
+    def search(self, user_id, query, limit=HISTORY_LIMIT):
+        """
+        Сначала совпадения по префиксу, затем нечёткие по триграммам (по убыванию сходства).
+        """
+        norm = normalize_meal_text(query)
+        if not norm:
+            return self.recent(user_id, limit)
+        tris = list(trigrams(norm))
+        with self.lock:
+            prefix_rows = self.db.execute(
+                "SELECT id, description, items, kcal, times FROM meal_history "
+                "WHERE user_id = ? AND desc_norm >= ? AND desc_norm < ? "
+                "ORDER BY times DESC LIMIT ?",
+                (user_id, norm, norm + "\uffff", limit),
+            ).fetchall()
+            if len(prefix_rows) >= limit:
+                # нечёткие всё равно не попадут в выдачу, а триграммный проход — самый дорогой
+                return [self._row(r) for r in prefix_rows]
+            placeholders = ",".join("?" * len(tris))
+            fuzzy_rows = self.db.execute(
+                "SELECT h.id, h.description, h.items, h.kcal, h.times, "
+                "       CAST(m.shared AS REAL) / ? AS similarity "
+                "FROM (SELECT meal_id, COUNT(*) AS shared FROM meal_trigrams "
+                f"      WHERE user_id = ? AND tri IN ({placeholders}) GROUP BY meal_id) m "
+                "JOIN meal_history h ON h.id = m.meal_id "
+                "WHERE similarity >= ? ORDER BY similarity DESC, h.times DESC, h.tri_count LIMIT ?",
+                (len(tris), user_id, *tris, HISTORY_MIN_SIMILARITY, limit),
+            ).fetchall()
+        found = [self._row(r) for r in prefix_rows]
+        seen = {m["id"] for m in found}
+        for r in fuzzy_rows:
+            if r[0] not in seen and len(found) < limit:
+                found.append(self._row(r[:5]))
+                seen.add(r[0])
+        return found
+
+
+_meal_store = None
+_meal_store_lock = threading.Lock()
+
+
+def get_meal_store():
+    global _meal_store
+    if _meal_store is None:
+        with _meal_store_lock:
+            if _meal_store is None:
+                _meal_store = MealStore(MEAL_STORE_PATH)
+    return _meal_store
+
+
+def history_analysis(entry):
+    return {"items": entry["items"], "total_kcal": entry["kcal"], "comment": ""}
+
+
+def format_history(entries, T):
+    lines = [T["history_header"]]
+    for m in entries:
+        times = f" ×{m['times']}" if m["times"] > 1 else ""
+        lines.append(f"#{m['id']} {m['description']} — {m['kcal']} kcal{times}")
+    lines.append("")
+    lines.append(T["history_repeat_hint"])
+    return "\n".join(lines)
+
+
+# ================================
+# MEAL LOGGING
+# ================================
+
+
+def log_meal_and_reply(chat_id, profile, lang, tz, description, analysis, remember=True):
+    """
+    Общий хвост для текста, фото и голоса: кап, дневник, запись приёма и ответ.
+    remember — положить описание с разбором в локальную историю для /repeat.
+    """
+    T = texts(lang)
+    meal_kcal_raw = analysis["total_kcal"]
+    items = analysis["items"]
+    comment = analysis.get("comment") or ""
+
+    if remember:
+        try:
+            get_meal_store().remember(tenant_key(chat_id), description, items, meal_kcal_raw)
+        except Exception as e:
+            print("meal history error:", e)
+
+    # лимит 1500 ккал на один приём
+    meal_kcal = meal_kcal_raw
+    cap_triggered = False
+    if meal_kcal > MEAL_KCAL_CAP:
+        cap_triggered = True
+        meal_kcal = MEAL_KCAL_CAP
+
+    today = get_today_key(tz)
+    try:
+        # strict: «приёмов нет» и «не прочитали» (база лежит, снимка за день нет) —
+        # разное; с номером 1 повтор очереди отбросил бы приём как дубль
+        meals_today = supabase_select("meals", {"user_id": f"eq.{chat_id}", "day": f"eq.{today}"}, strict=True)
+    except Exception as e:
+        print("meals_today error:", e)
+        send_message(chat_id, T["diary_unavailable"])
+        return
+    meal_number = len(meals_today) + 1
+
+    new_total = update_diary_kcal(chat_id, today, meal_kcal)
+    if new_total is None:
+        # итог дня не прочитан: приём не пишем, чтобы не затереть дневник
+        send_message(chat_id, T["diary_unavailable"])
+        return
+    add_meal_record(chat_id, today, meal_number, description, meal_kcal, items)
+
+    target = calc_target_kcal(profile)
+    left = target - new_total
+
+    # формируем ответ
+    if lang == "ru":
+        lines = [f"{T['meal_header']}"]
+        for it in items:
+            lines.append(f"• {it['name']}: {it['kcal']} ккал")
+        if comment:
+            lines.append(f"\nКомментарий: {comment}")
+    elif lang == "sr":
+        lines = [f"{T['meal_header']}"]
+        for it in items:
+            lines.append(f"• {it['name']}: {it['kcal']} kcal")
+        if comment:
+            lines.append(f"\nKomentar: {comment}")
+    else:
+        lines = [f"{T['meal_header']}"]
+        for it in items:
+            lines.append(f"• {it['name']}: {it['kcal']} kcal")
+        if comment:
+            lines.append(f"\nComment: {comment}")
+
+    reply = "\n".join(lines)
+    reply += T["daily_summary"].format(
+        meal_kcal=meal_kcal,
+        total_kcal=new_total,
+        target_kcal=target,
+        left_kcal=left,
+    )
+
+    if cap_triggered:
+        reply += T["meal_cap_note"].format(
+            raw_kcal=meal_kcal_raw,
+            cap_kcal=MEAL_KCAL_CAP,
+        )
+
+    if left < 0:
+        over = abs(left)
+        reply += T["daily_overeat"].format(over_kcal=over)
+
+    send_message(chat_id, reply)
 
 
 # ================================
@@ -829,8 +3221,24 @@ def send_message(chat_id, text):
 # ================================
 
 
+@app.route("/bot/<tenant_id>", methods=["POST"])
+def tenant_webhook(tenant_id):
+    tenant = TENANTS.get(tenant_id)
+    if tenant is None:
+        return "Not found", 404
+    with tenant_context(tenant):
+        return telegram_webhook()
+
+
 @app.route("/", methods=["POST"])
 def telegram_webhook():
+    tenant = current_tenant()
+    if tenant.webhook_secret and not hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), tenant.webhook_secret,
+    ):
+        return "Forbidden", 403
+    metrics.incr("updates")
+
     data = request.json
     if not data or "message" not in data:
         return "OK"
@@ -843,7 +3251,7 @@ def telegram_webhook():
 
     profile = get_profile(chat_id)
     lang = (profile.get("lang") if profile and profile.get("lang") else "ru")
-    T = TEXT.get(lang, TEXT["ru"])
+    T = texts(lang)
 
     # /start — выбор языка
     if text.lower() == "/start":
@@ -861,7 +3269,7 @@ def telegram_webhook():
         lang_map = {"1": "ru", "2": "en", "3": "sr"}
         lang = lang_map[text]
         save_profile(chat_id, {"lang": lang})
-        T = TEXT[lang]
+        T = texts(lang)
         send_message(chat_id, T["profile_intro"])
         send_message(chat_id, T["profile_template"])
         return "OK"
@@ -869,10 +3277,10 @@ def telegram_webhook():
     # попытка распарсить профиль
     parsed_prof = parse_profile(text)
     if parsed_prof:
-        save_profile(chat_id, {"lang": lang, **parsed_prof})
-        profile = get_profile(chat_id)
-        lang = profile.get("lang", lang)
-        T = TEXT.get(lang, TEXT["ru"])
+        # берём то, что записали: если upsert не прошёл, перечитанный профиль был бы None
+        profile = save_profile(chat_id, {"lang": lang, **parsed_prof})
+        lang = profile.get("lang") or lang
+        T = texts(lang)
         target = calc_target_kcal(profile)
 
         send_message(chat_id, T["profile_saved"])
@@ -884,10 +3292,12 @@ def telegram_webhook():
     # обновим профиль ещё раз (вдруг уже есть)
     profile = get_profile(chat_id)
     lang = (profile.get("lang") if profile and profile.get("lang") else lang)
-    T = TEXT.get(lang, TEXT["ru"])
+    T = texts(lang)
+
+    tz = profile_tz(profile)
+    scheduler.add_zone(tz)
 
-    essential_keys = ["age", "height", "weight", "goal", "activity_factor", "sex"]
-    has_full_profile = bool(profile and all(profile.get(k) is not None for k in essential_keys))
+    has_full_profile = is_full_profile(profile)
 
     # команды, зависящие от профиля
     if text.lower() == "/status" or text.lower() == "/calc":
@@ -895,9 +3305,8 @@ def telegram_webhook():
             send_message(chat_id, T["status_no_profile"])
             return "OK"
         target = calc_target_kcal(profile)
-        today = get_today_key()
-        diary = get_diary(chat_id, today)
-        total = diary.get("total_kcal") or 0
+        today = get_today_key(tz)
+        total = get_day_total(chat_id, today) or 0
         left = target - total
         sex = profile.get("sex") or "m"
         sex_label = {"m": "м", "f": "ж"}.get(sex, sex)
@@ -917,11 +3326,37 @@ def telegram_webhook():
             send_message(chat_id, T["calc_hint"])
         return "OK"
 
+    if text.lower() == "/forecast":
+        if not has_full_profile:
+            send_message(chat_id, T["status_no_profile"])
+            return "OK"
+        today = get_today_key(tz)
+        # от ключа дня, а не через tz_day_key: тот закэшировал бы окно 28-дневной давности
+        since = (datetime.datetime.strptime(today, "%Y%m%d")
+                 - datetime.timedelta(days=FORECAST_WINDOW_DAYS)).strftime("%Y%m%d")
+        rows = supabase_select("diary_days", {
+            "user_id": f"eq.{chat_id}",
+            "day": f"gte.{since}",
+            "order": "day.asc",
+        })
+        fc = forecast_weight(profile, rows, today)
+        if not fc:
+            send_message(chat_id, T["forecast_not_enough"].format(days=FORECAST_MIN_DAYS))
+            return "OK"
+        reply = T["forecast"].format(**fc)
+        if fc["days_to_goal"] is not None:
+            eta = datetime.datetime.now(resolve_tz(tz)) + datetime.timedelta(days=fc["days_to_goal"])
+            reply += T["forecast_eta"].format(goal=float(profile["goal"]), date=eta.strftime("%d.%m.%Y"))
+        else:
+            reply += T["forecast_no_eta"]
+        send_message(chat_id, reply)
+        return "OK"
+
     if text.lower() == "/reset":
         if not has_full_profile:
             send_message(chat_id, T["status_no_profile"])
             return "OK"
-        reset_diary_today(chat_id)
+        reset_diary_today(chat_id, tz)
         send_message(chat_id, T["reset_done"])
         return "OK"
 
@@ -937,86 +3372,396 @@ def telegram_webhook():
         send_message(chat_id, T["cmd_age_hint"])
         return "OK"
 
+    if text.lower() == "/tz" or text.lower().startswith("/tz "):
+        tz_arg = text[3:].strip()
+        if not tz_arg:
+            send_message(chat_id, T["cmd_tz_hint"].format(tz=tz))
+            return "OK"
+        if not resolve_tz(tz_arg):
+            send_message(chat_id, T["tz_invalid"].format(tz=tz_arg))
+            return "OK"
+        save_profile(chat_id, {"tz": tz_arg})
+        scheduler.add_zone(tz_arg)
+        local_now = datetime.datetime.now(resolve_tz(tz_arg)).strftime("%H:%M")
+        send_message(chat_id, T["tz_saved"].format(tz=tz_arg, time=local_now))
+        return "OK"
+
     # если профиль не заполнен — отказываемся считать
     if not has_full_profile:
         send_message(chat_id, T["need_profile_first"])
         return "OK"
 
-    # дальше — логика еды
+    new_weight = parse_weight_update(text)
+    if new_weight is not None:
+        profile = save_profile(chat_id, {"weight": new_weight})
+        send_message(chat_id, T["weight_saved"].format(
+            weight=new_weight,
+            trend=round(float(profile.get("weight_trend") or new_weight), 1),
+            rate=float(profile.get("weight_rate") or 0),
+            kcal=calc_target_kcal(profile),
+        ))
+        return "OK"
+
+    if text.lower() == "/trend":
+        if profile.get("weight_trend") is None:
+            send_message(chat_id, T["trend_empty"])
+            return "OK"
+        send_message(chat_id, T["trend"].format(
+            weight=float(profile["weight"]),
+            trend=round(float(profile["weight_trend"]), 1),
+            rate=float(profile.get("weight_rate") or 0),
+            points=int(profile.get("weight_points") or 1),
+            kcal=calc_target_kcal(profile),
+        ))
+        return "OK"
+
+    if text.lower() == "/history" or text.lower().startswith("/history "):
+        query = text[len("/history"):].strip()
+        store = get_meal_store()
+        entries = store.search(tenant_key(chat_id), query) if query else store.recent(tenant_key(chat_id))
+        send_message(chat_id, format_history(entries, T) if entries else T["history_empty"])
+        return "OK"
+
+    if text.lower() == "/repeat" or text.lower().startswith("/repeat "):
+        query = text[len("/repeat"):].strip().lstrip("#")
+        if not query:
+            send_message(chat_id, T["history_repeat_hint"])
+            return "OK"
+        store = get_meal_store()
+        user_key = tenant_key(chat_id)
+        # номер из /history: только ASCII-цифры и в пределах INTEGER SQLite
+        if re.fullmatch(r"[0-9]{1,18}", query):
+            entry = store.get(user_key, int(query))
+        else:
+            entry = next(iter(store.search(user_key, query, 1)), None)
+        if not entry:
+            send_message(chat_id, T["repeat_not_found"])
+            return "OK"
+        log_meal_and_reply(chat_id, profile, lang, tz, entry["description"], history_analysis(entry))
+        return "OK"
+
+    # фото еды (подпись — необязательная подсказка)
+    if msg.get("photo"):
+        caption = (msg.get("caption") or "").strip()
+        if submit_photo(chat_id, profile, lang, tz, msg["photo"], caption) == "busy":
+            send_message(chat_id, T["photo_busy"])
+        return "OK"
+
+    # голосовое: распознаём в фоне и дальше работаем с текстом как обычно
+    if msg.get("voice"):
+        status = submit_voice(chat_id, profile, lang, tz, msg["voice"])
+        if status == "busy":
+            send_message(chat_id, T["voice_busy"])
+        elif status == "rejected":
+            send_message(chat_id, T["cannot_parse_voice"])
+        return "OK"
+
+    handle_meal_text(chat_id, profile, lang, tz, text)
+    return "OK"
+
+
+def handle_meal_text(chat_id, profile, lang, tz, text):
+    """
+    Текст приёма пищи (набранный или распознанный из голосового) -> запись и ответ.
+    """
+    T = texts(lang)
     if not looks_like_meal(text):
         # если это не похоже на еду — мягко возвращаем к формату
         send_message(chat_id, T["ask_meal_brief"])
-        return "OK"
+        return
+
+    # то же описание уже разбирали — берём разбор из истории без запроса к ИИ
+    try:
+        known = get_meal_store().exact(tenant_key(chat_id), text)
+    except Exception as e:
+        print("meal history error:", e)
+        known = None
+    if known:
+        log_meal_and_reply(chat_id, profile, lang, tz, text, history_analysis(known))
+        return
 
     analysis = ai_meal_analysis(text, lang)
     if not analysis:
         send_message(chat_id, T["cannot_parse_meal"])
         send_message(chat_id, T["meal_input_help"])
-        return "OK"
+        return
 
-    meal_kcal_raw = analysis["total_kcal"]
-    items = analysis["items"]
-    comment = analysis.get("comment") or ""
+    log_meal_and_reply(chat_id, profile, lang, tz, text, analysis)
 
-    # лимит 1500 ккал на один приём
-    meal_kcal = meal_kcal_raw
-    cap_triggered = False
-    if meal_kcal > MEAL_KCAL_CAP:
-        cap_triggered = True
-        meal_kcal = MEAL_KCAL_CAP
 
-    today = get_today_key()
-    meals_today = supabase_select("meals", {"user_id": f"eq.{chat_id}", "day": f"eq.{today}"})
-    meal_number = len(meals_today) + 1
+@app.route("/", methods=["GET"])
+def home():
+    return "AI Calories Bot with HF Router is running!"
 
-    new_total = update_diary_kcal(chat_id, today, meal_kcal)
-    add_meal_record(chat_id, today, meal_number, text, meal_kcal)
 
-    target = calc_target_kcal(profile)
-    left = target - new_total
+@app.route("/metrics", methods=["GET"])
+def metrics_view():
+    return metrics.snapshot()
 
-    # формируем ответ
-    if lang == "ru":
-        lines = [f"{T['meal_header']}"]
-        for it in items:
-            lines.append(f"• {it['name']}: {it['kcal']} ккал")
-        if comment:
-            lines.append(f"\nКомментарий: {comment}")
-    elif lang == "sr":
-        lines = [f"{T['meal_header']}"]
-        for it in items:
-            lines.append(f"• {it['name']}: {it['kcal']} kcal")
-        if comment:
-            lines.append(f"\nKomentar: {comment}")
-    else:
-        lines = [f"{T['meal_header']}"]
-        for it in items:
-            lines.append(f"• {it['name']}: {it['kcal']} kcal")
-        if comment:
-            lines.append(f"\nComment: {comment}")
 
-    reply = "\n".join(lines)
-    reply += T["daily_summary"].format(
-        meal_kcal=meal_kcal,
-        total_kcal=new_total,
-        target_kcal=target,
-        left_kcal=left,
-    )
+@app.route("/health", methods=["GET"])
+def health_view():
+    """
+    Всегда 200, пока процесс жив: в деградированном режиме бот продолжает отвечать.
+    status=degraded — база недоступна или очередь записей ещё не дописана.
+    """
+    if not FAILOVER_ENABLED:
+        return {"status": "ok"}
+    tenants = get_failover().health()
+    degraded = any(t["supabase"] == "down" or t["pending_writes"] for t in tenants.values())
+    return {"status": "degraded" if degraded else "ok", "tenants": tenants}
 
-    if cap_triggered:
-        reply += T["meal_cap_note"].format(
-            raw_kcal=meal_kcal_raw,
-            cap_kcal=MEAL_KCAL_CAP,
-        )
 
-    if left < 0:
-        over = abs(left)
-        reply += T["daily_overeat"].format(over_kcal=over)
+# ================================
+# ADMIN API
+# ================================
 
-    send_message(chat_id, reply)
-    return "OK"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 
 
-@app.route("/", methods=["GET"])
-def home():
-    return "AI Calories Bot with HF Router is running!"
+def admin_required(view):
+    """
+    Bearer-токен из ADMIN_TOKEN; без него админка выключена целиком.
+    ?tenant=<id> — с каким ботом работать (по умолчанию основной).
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        auth = request.headers.get("Authorization", "")
+        if not ADMIN_TOKEN or not hmac.compare_digest(auth, f"Bearer {ADMIN_TOKEN}"):
+            return Response("unauthorized\n", status=401)
+        tenant = TENANTS.get(request.args.get("tenant", "default"))
+        if tenant is None:
+            return Response("unknown tenant\n", status=404)
+        with tenant_context(tenant):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def ndjson_response(rows):
+    """
+    Потоковый ответ: по строке JSON на запись, память — одна страница из Supabase.
+    """
+    # генератор докручивается уже после выхода из view — в контексте его арендатора
+    ctx = contextvars.copy_context()
+
+    def generate():
+        it = iter(rows)
+        try:
+            while True:
+                try:
+                    row = ctx.run(next, it)
+                except StopIteration:
+                    return
+                yield json.dumps(row, ensure_ascii=False, default=str) + "\n"
+        except Exception as e:
+            # заголовки уже ушли — сообщаем об обрыве последней строкой
+            print("admin stream error:", e)
+            yield json.dumps({"error": str(e)}) + "\n"
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def admin_page_size():
+    """
+    ?page_size=, не больше 5000; None, если это не положительное целое — тогда 400.
+    """
+    try:
+        size = int(request.args.get("page_size", SUPABASE_PAGE_SIZE))
+    except ValueError:
+        return None
+    return min(size, 5000) if size > 0 else None
+
+
+@app.route("/admin/users", methods=["GET"])
+@admin_required
+def admin_list_users():
+    """
+    Профили с нормой; ?day=YYYYMMDD добавляет итог дневника за этот день
+    (один запрос in.(...) на страницу). ?after=<user_id> — продолжить с места.
+    """
+    day = request.args.get("day")
+    after = request.args.get("after")
+    page_size = admin_page_size()
+    if page_size is None:
+        return Response("page_size must be a positive integer\n", status=400)
+
+    def rows():
+        for page in supabase_select_keyset("profiles", after=after, page_size=page_size):
+            targets = calc_target_kcal_bulk(page)
+            totals = {}
+            if day:
+                diary = supabase_select_in("diary_days", "user_id", [p["user_id"] for p in page],
+                                           {"day": f"eq.{day}"}, select="user_id,total_kcal")
+                totals = {str(d["user_id"]): d.get("total_kcal") or 0 for d in diary}
+            for p, target in zip(page, targets):
+                row = {**p, "target_kcal": int(target)}
+                if day:
+                    row["total_kcal"] = totals.get(str(p["user_id"]), 0)
+                yield row
+
+    return ndjson_response(rows())
+
+
+@app.route("/admin/recompute-targets", methods=["POST"])
+@admin_required
+def admin_recompute_targets():
+    """
+    Пересчёт норм для всех профилей страницами (векторно). ?save=1 — записать
+    profiles.target_kcal (см. README) одним upsert на страницу. Пишутся только
+    user_id и target_kcal, чтобы не затереть то, что пользователь поменял, пока идёт поток;
+    ошибка записи обрывает поток строкой {"error": ...}.
+    """
+    save = request.args.get("save") == "1"
+    page_size = admin_page_size()
+    if page_size is None:
+        return Response("page_size must be a positive integer\n", status=400)
+
+    def rows():
+        for page in supabase_select_keyset("profiles", page_size=page_size):
+            targets = calc_target_kcal_bulk(page)
+            if save:
+                supabase_upsert("profiles", [
+                    {"user_id": p["user_id"], "target_kcal": int(t)} for p, t in zip(page, targets)
+                ], strict=True)
+            for p, target in zip(page, targets):
+                yield {"user_id": p["user_id"], "target_kcal": int(target)}
+
+    return ndjson_response(rows())
+
+
+@app.route("/admin/reset-diaries", methods=["POST"])
+@admin_required
+def admin_reset_diaries():
+    """
+    Тело: {"user_ids": [...]} или {"all": true}; "day": "YYYYMMDD" — иначе «сегодня»
+    в часовом поясе каждого пользователя. Обнуление — пакетный upsert по SUPABASE_IN_BATCH;
+    ошибка записи обрывает поток строкой {"error": ...}.
+    """
+    body = request.get_json(silent=True) or {}
+    day = body.get("day")
+    user_ids = [str(u) for u in body.get("user_ids") or []]
+    if not user_ids and not body.get("all"):
+        return Response("user_ids or all required\n", status=400)
+
+    def profile_pages():
+        if body.get("all"):
+            yield from supabase_select_keyset("profiles", select="user_id,tz")
+            return
+        for i in range(0, len(user_ids), SUPABASE_IN_BATCH):
+            yield supabase_select_in("profiles", "user_id", user_ids[i: i + SUPABASE_IN_BATCH],
+                                     select="user_id,tz")
+
+    def rows():
+        for page in profile_pages():
+            if not page:
+                continue
+            batch = [
+                {"user_id": p["user_id"], "day": day or get_today_key(profile_tz(p)), "total_kcal": 0}
+                for p in page
+            ]
+            # ошибка записи обрывает поток, а не уходит в очередь молча
+            supabase_upsert("diary_days", batch, strict=True)
+            for r in batch:
+                # в кэше лежит «сегодня»; сброс прошлого дня не должен его подменять
+                diary_cache_drop(r["user_id"])
+            yield {"reset": len(batch), "last_user_id": batch[-1]["user_id"]}
+
+    return ndjson_response(rows())
+
+
+# Что входит в выгрузку данных пользователя (GDPR): таблица -> ключ для постраничного чтения
+USER_EXPORT_TABLES = [
+    ("diary_days", "day"),
+    ("meals", "id"),
+    ("meal_items", "id"),
+    ("weight_log", "ts"),
+]
+
+
+@app.route("/admin/users/<user_id>/export", methods=["GET"])
+@admin_required
+def admin_export_user(user_id):
+    def rows():
+        for p in supabase_fetch("profiles", {"select": "*", "user_id": f"eq.{user_id}"}):
+            yield {"table": "profiles", "row": p}
+        for table, key in USER_EXPORT_TABLES:
+            for page in supabase_select_keyset(table, {"user_id": f"eq.{user_id}"}, key=key):
+                for row in page:
+                    yield {"table": table, "row": row}
+
+    return ndjson_response(rows())
+
+
+# ================================
+# ANALYTICS EXPORT
+# ================================
+
+# Колонки и типы Arrow для выгрузки; страницы читаются по id (keyset)
+EXPORT_SCHEMAS = {
+    "meal_items": [
+        ("id", "int64"),
+        ("user_id", "string"),
+        ("day", "string"),
+        ("meal_number", "int32"),
+        ("position", "int16"),
+        ("name", "string"),
+        ("kcal", "int32"),
+    ],
+    "meals": [
+        ("id", "int64"),
+        ("user_id", "string"),
+        ("day", "string"),
+        ("meal_number", "int32"),
+        ("description", "string"),
+        ("kcal", "int32"),
+    ],
+}
+
+
+def export_table_parquet(table, output, page_size=None, compression="zstd"):
+    """
+    Выгружает таблицу в Parquet потоково: страница PostgREST -> row group.
+    В памяти одновременно только одна страница. Нужен pyarrow (pip install pyarrow).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = EXPORT_SCHEMAS[table]
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+    select = ",".join(name for name, _ in columns)
+    rows_written = 0
+    with pq.ParquetWriter(output, schema, compression=compression) as writer:
+        for page in supabase_select_keyset(table, key="id", select=select, page_size=page_size):
+            batch = pa.record_batch(
+                [pa.array([row.get(name) for row in page], type=schema.field(name).type) for name, _ in columns],
+                schema=schema,
+            )
+            writer.write_batch(batch)
+            rows_written += len(page)
+    return rows_written
+
+
+@app.cli.command("export-meals")
+@click.argument("output")
+@click.option("--table", type=click.Choice(sorted(EXPORT_SCHEMAS)), default="meal_items")
+@click.option("--page-size", type=int, default=5000)
+@click.option("--tenant", type=click.Choice(sorted(TENANTS)), default="default")
+def export_meals_command(output, table, page_size, tenant):
+    """Выгрузить meals/meal_items всех пользователей в Parquet (zstd)."""
+    with tenant_context(TENANTS[tenant]):
+        rows = export_table_parquet(table, output, page_size=page_size)
+    click.echo(f"{table}: {rows} rows -> {output}")
+
+
+# ================================
+# BOOT
+# ================================
+
+if STARTUP_MODE == "eager":
+    validate_config()
+    start_prewarm()
+
+if SCHEDULER_ENABLED:
+    start_scheduler()
+
+if FAILOVER_ENABLED:
+    start_replayer()
@@ -0,0 +1,108 @@
+"""
+Бенчмарк локальной истории приёмов (MealStore) на 100k+ описаний одного пользователя.
+
+Описания собираются из блюд, способов готовки, гарниров и граммовок (ru/en),
+как их пишут в бота. Замеряются exact (повтор того же описания), search по префиксу,
+нечёткий search с опечатками и промах.
+
+    python bench/meal_history.py
+    python bench/meal_history.py --meals 200000 --queries 1000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("STARTUP_MODE", "lazy")
+os.environ.setdefault("FAILOVER_ENABLED", "0")
+
+import app  # noqa: E402
+
+FOODS = [
+    "овсянка", "гречка", "рис", "булгур", "киноа", "паста", "картофель", "омлет", "яичница",
+    "творог", "сырники", "блины", "курица", "индейка", "говядина", "свинина", "лосось",
+    "тунец", "треска", "креветки", "тофу", "нут", "чечевица", "фасоль", "салат цезарь",
+    "греческий салат", "борщ", "суп", "плов", "пицца", "бургер", "шаурма", "ролл",
+    "oatmeal", "chicken breast", "salmon", "rice bowl", "pasta", "steak", "scrambled eggs",
+    "greek yogurt", "pancakes", "avocado toast", "burrito", "ramen", "poke bowl",
+]
+METHODS = ["", "варёный", "жареный", "запечённый", "на пару", "гриль", "grilled", "baked", "fried"]
+SIDES = [
+    "", "с овощами", "с салатом", "с сыром", "с малиной", "с бананом", "с мёдом", "с орехами",
+    "с соусом", "с хлебом", "with rice", "with salad", "with berries", "with cheese",
+    "with avocado", "with fries", "и кофе", "и чай", "and coffee", "and juice",
+]
+GRAMS = list(range(50, 501, 10))
+
+
+def make_descriptions(n, rng):
+    seen = set()
+    while len(seen) < n:
+        parts = [f"{rng.choice(GRAMS)}г", rng.choice(METHODS), rng.choice(FOODS), rng.choice(SIDES)]
+        seen.add(" ".join(p for p in parts if p))
+    return list(seen)
+
+
+def typo(text, rng):
+    chars = list(text)
+    for _ in range(2):
+        i = rng.randrange(len(chars))
+        chars[i] = rng.choice("абвгдеклмнопрстaeiou")
+    return "".join(chars)
+
+
+def timed(fn, args_list):
+    samples = []
+    for args in args_list:
+        started = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--meals", type=int, default=120_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = app.MealStore(os.path.join(tmp, "meals.sqlite3"))
+        user = "bench-user"
+        descriptions = make_descriptions(args.meals, rng)
+        started = time.perf_counter()
+        for d in descriptions:
+            store.remember(user, d, [{"name": d, "kcal": 300}], 300)
+        # соседние пользователи: индекс общий, выборка — по user_id
+        for other in range(20):
+            for d in rng.sample(descriptions, 500):
+                store.remember(f"other-{other}", d, [{"name": d, "kcal": 300}], 300)
+        build_s = time.perf_counter() - started
+
+        picks = [rng.choice(descriptions) for _ in range(args.queries)]
+        cases = {
+            "exact (hit)": (store.exact, [(user, d) for d in picks]),
+            "exact (miss)": (store.exact, [(user, d + " extra") for d in picks]),
+            "search prefix": (store.search, [(user, d[: max(6, len(d) // 2)]) for d in picks]),
+            "search fuzzy (2 typos)": (store.search, [(user, typo(d, rng)) for d in picks]),
+            "search word": (store.search, [(user, rng.choice(FOODS)) for _ in picks]),
+        }
+
+        print(f"{args.meals} meals for one user (+10k for 20 others), built in {build_s:.1f}s")
+        print(f"{'lookup':<24} {'p50 ms':>8} {'p95 ms':>8}")
+        for name, (fn, calls) in cases.items():
+            p50, p95 = timed(fn, calls)
+            print(f"{name:<24} {p50:>8.3f} {p95:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Бенчмарк холодного старта: время `import app` в свежем процессе.
+
+Сравнивает версии app.py из git (по умолчанию baseline и HEAD) в режимах
+STARTUP_MODE=lazy и eager. Каждая версия запускается из временного каталога,
+чтобы не зависеть от рабочей копии.
+
+    python bench/startup.py
+    python bench/startup.py --ref 9abbea8 --ref HEAD --runs 20
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILES = ["app.py", "stt_worker.py"]
+
+PROBE = (
+    "import time; t = time.perf_counter(); import app; "
+    "print(time.perf_counter() - t)"
+)
+
+DUMMY_ENV = {
+    "TELEGRAM_TOKEN": "bench",
+    "SUPABASE_URL": "http://127.0.0.1:9",
+    "SUPABASE_ANON_KEY": "bench",
+    "AI_ENDPOINT": "http://127.0.0.1:9/v1/chat/completions",
+    "AI_KEY": "bench",
+    "AI_MODEL": "bench",
+    "SCHEDULER_ENABLED": "0",
+}
+
+
+def checkout(ref, dest):
+    for name in FILES:
+        r = subprocess.run(["git", "show", f"{ref}:{name}"], cwd=ROOT, capture_output=True)
+        if r.returncode == 0:
+            with open(os.path.join(dest, name), "wb") as f:
+                f.write(r.stdout)
+
+
+def measure(workdir, mode, runs):
+    env = {**os.environ, **DUMMY_ENV, "STARTUP_MODE": mode,
+           "FAILOVER_PATH": os.path.join(workdir, "failover.sqlite3")}
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", PROBE], cwd=workdir, env=env,
+                             capture_output=True, text=True, check=True)
+        samples.append(float(out.stdout.strip().splitlines()[-1]) * 1000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ref", action="append", help="git-ревизия (можно несколько)")
+    parser.add_argument("--runs", type=int, default=15)
+    args = parser.parse_args()
+    refs = args.ref or ["9abbea8", "HEAD"]
+
+    print(f"{'ref':<10} {'mode':<6} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    for ref in refs:
+        with tempfile.TemporaryDirectory() as tmp:
+            checkout(ref, tmp)
+            for mode in ("lazy", "eager"):
+                s = measure(tmp, mode, args.runs)
+                print(f"{ref:<10} {mode:<6} {statistics.median(s):>10.1f} {min(s):>8.1f} {max(s):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
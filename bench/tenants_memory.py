@@ -0,0 +1,94 @@
+"""
+Бенчмарк памяти мультиарендности: один процесс на N ботов против N процессов по боту.
+
+Каждый замер — свежий процесс: import app, затем прогрев каждого арендатора
+(тексты всех языков, HTTP-сессия, бэкенд модели, отправитель, numpy-расчёт нормы).
+Печатается RSS и PSS (/proc/self/smaps_rollup, только Linux) после прогрева.
+
+    python bench/tenants_memory.py --tenants 10
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r"""
+import app
+
+def rss_pss():
+    out = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            if key in ("Rss", "Pss"):
+                out[key] = int(rest.split()[0])
+    return out["Rss"], out["Pss"]
+
+profile = {"sex": "m", "weight": 80, "height": 180, "age": 30, "activity_factor": 1.2}
+app.http()
+for tenant in app.TENANTS.values():
+    with app.tenant_context(tenant):
+        for lang in ("ru", "en", "sr"):
+            app.texts(lang)
+        app.get_backend("remote")
+        app.get_bulk_sender()
+        app.supabase_headers(json_mode=True)
+        app.calc_target_kcal_bulk([profile] * 100)
+        app.metrics.incr("updates")
+print(*rss_pss())
+"""
+
+DUMMY_ENV = {
+    "TELEGRAM_TOKEN": "bench",
+    "SUPABASE_URL": "http://127.0.0.1:9",
+    "SUPABASE_ANON_KEY": "bench",
+    "AI_ENDPOINT": "http://127.0.0.1:9/v1/chat/completions",
+    "AI_KEY": "bench",
+    "AI_MODEL": "bench",
+    "SCHEDULER_ENABLED": "0",
+    "STARTUP_MODE": "lazy",
+}
+
+
+def run(tmp, tenants):
+    env = {**os.environ, **DUMMY_ENV, "FAILOVER_PATH": os.path.join(tmp, "failover.sqlite3")}
+    if tenants > 1:
+        path = os.path.join(tmp, f"tenants_{tenants}.json")
+        with open(path, "w") as f:
+            json.dump([
+                {"id": f"t{i}", "telegram_token": f"token{i}", "supabase_schema": f"t{i}",
+                 "texts": {"ru": {"history_empty": f"t{i}"}}}
+                for i in range(1, tenants)
+            ], f)
+        env["TENANTS_FILE"] = path
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True)
+    rss, pss = map(int, out.stdout.split()[-2:])
+    return rss / 1024, pss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tenants", type=int, default=10)
+    args = parser.parse_args()
+    n = args.tenants
+
+    with tempfile.TemporaryDirectory() as tmp:
+        one_rss, one_pss = run(tmp, 1)
+        many_rss, many_pss = run(tmp, n)
+
+    print(f"{'setup':<28} {'RSS MiB':>9} {'PSS MiB':>9}")
+    print(f"{'1 process, 1 tenant':<28} {one_rss:>9.1f} {one_pss:>9.1f}")
+    print(f"{f'1 process, {n} tenants':<28} {many_rss:>9.1f} {many_pss:>9.1f}")
+    print(f"{f'{n} processes, 1 tenant each':<28} {one_rss * n:>9.1f} {one_pss * n:>9.1f}")
+    print(f"saved: {one_rss * n - many_rss:.1f} MiB RSS, "
+          f"{one_pss * n - many_pss:.1f} MiB PSS (N processes = N x one measured process)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""
+Процесс-воркер для распознавания голосовых (faster-whisper, только CPU).
+
+Отдельный модуль, чтобы дочерние процессы пула не импортировали app.py
+со всем Flask-приложением, планировщиком и пулами потоков.
+"""
+
+import io
+import time
+
+_model = None
+
+
+def init_worker(model_name, cpu_threads):
+    global _model
+    from faster_whisper import WhisperModel
+
+    # модель грузится один раз на процесс и живёт, пока жив воркер
+    _model = WhisperModel(model_name, device="cpu", compute_type="int8", cpu_threads=cpu_threads)
+
+
+def transcribe(data, submitted_at, language=None):
+    """
+    OGG/Opus байты -> (текст, ожидание в очереди, сек; длительность распознавания, сек).
+    """
+    started = time.time()
+    segments, _ = _model.transcribe(io.BytesIO(data), language=language, beam_size=1, vad_filter=True)
+    text = " ".join(seg.text.strip() for seg in segments).strip()
+    return text, started - submitted_at, time.time() - started
@@ -0,0 +1,23 @@
+"""
+Окружение для import app: фиктивный конфиг, локальные SQLite во временном каталоге,
+без планировщика и фонового повтора (тесты дёргают всё сами).
+"""
+
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="calories-bot-test-")
+os.environ.update({
+    "TELEGRAM_TOKEN": "test",
+    "SUPABASE_URL": "http://127.0.0.1:9",
+    "SUPABASE_ANON_KEY": "test",
+    "STARTUP_MODE": "lazy",
+    "SCHEDULER_ENABLED": "0",
+    "FAILOVER_ENABLED": "1",
+    "FAILOVER_PATH": os.path.join(_tmp, "queue.sqlite3"),
+    "FAILOVER_SNAPSHOT_PATH": os.path.join(_tmp, "snapshot.sqlite3"),
+    "FAILOVER_REPLAY_INTERVAL": "3600",
+    "MEAL_STORE_PATH": os.path.join(_tmp, "meals.sqlite3"),
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,216 @@
+"""
+Деградированный режим: локальный стенд PostgREST включается и выключается,
+приёмы пищи копятся в очереди и дописываются без дублей, когда база вернулась.
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import app
+
+UPSERT_KEYS = {"profiles": ("user_id",), "diary_days": ("user_id", "day")}
+
+
+class FakePostgREST:
+    """
+    Минимальный PostgREST: eq-фильтры в GET, upsert с merge-duplicates,
+    insert с on_conflict + ignore-duplicates. lose_response — таблица, следующий POST
+    в которую применяется, но получает 503 (запрос дошёл, ответ потерялся).
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.lose_response = None
+        self.server = None
+        self.port = None
+
+    def rows(self, table):
+        return self.tables.setdefault(table, [])
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                rows = [
+                    r for r in fake.rows(url.path.rsplit("/", 1)[-1])
+                    if all(str(r.get(k)) == v[0][3:] for k, v in query.items() if v[0].startswith("eq."))
+                ]
+                self.reply(200, rows)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                table = url.path.rsplit("/", 1)[-1]
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                prefer = self.headers.get("Prefer") or ""
+                conflict = parse_qs(url.query).get("on_conflict", [""])[0].split(",")
+                stored = fake.rows(table)
+                for row in body if isinstance(body, list) else [body]:
+                    if "merge-duplicates" in prefer:
+                        keys = UPSERT_KEYS[table]
+                        stored[:] = [r for r in stored if any(str(r[k]) != str(row[k]) for k in keys)]
+                    elif "ignore-duplicates" in prefer and any(
+                        all(str(r.get(k)) == str(row.get(k)) for k in conflict) for r in stored
+                    ):
+                        continue
+                    stored.append(row)
+                if fake.lose_response == table:
+                    fake.lose_response = None
+                    self.reply(503, {"message": "upstream timeout"})
+                    return
+                self.reply(201, body)
+
+            def reply(self, status, data):
+                raw = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+        return Handler
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port or 0), self.handler())
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def postgrest(monkeypatch):
+    fake = FakePostgREST()
+    fake.start()
+    monkeypatch.setattr(app.DEFAULT_TENANT, "supabase_url", f"http://127.0.0.1:{fake.port}")
+    yield fake
+    if fake.server:
+        fake.stop()
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    sent = []
+    monkeypatch.setattr(app, "send_message", lambda chat_id, text, **kwargs: sent.append(text))
+    monkeypatch.setattr(app, "ai_meal_analysis", lambda text, lang: {
+        "items": [{"name": "oatmeal", "kcal": 300}], "total_kcal": 300, "comment": "",
+    })
+    client = app.app.test_client()
+
+    def meal(chat_id, text="oatmeal with milk"):
+        assert client.post("/", json={"message": {"chat": {"id": chat_id}, "text": text}}).status_code == 200
+        return sent[-1]
+
+    meal.health = lambda: client.get("/health").get_json()
+    return meal
+
+
+def add_profile(postgrest, user_id):
+    postgrest.rows("profiles").append({
+        "user_id": str(user_id), "lang": "en", "tz": "UTC", "sex": "m",
+        "weight": 80, "height": 180, "age": 30, "goal": 75, "activity_factor": 1.2,
+    })
+
+
+def go_down(postgrest):
+    postgrest.stop()
+
+
+def come_back(postgrest):
+    postgrest.start()
+    # окно «не ходить в базу» после сбоя тест не ждёт
+    app.get_failover().mark_up()
+
+
+def test_meals_queue_while_down_and_drain_after_recovery(postgrest, bot):
+    add_profile(postgrest, 101)
+    bot(101)
+    assert [m["meal_number"] for m in postgrest.rows("meals")] == [1]
+    assert bot.health()["status"] == "ok"
+
+    go_down(postgrest)
+    reply = bot(101)
+    bot(101)
+    assert "Remaining today" in reply
+    health = bot.health()
+    assert health["status"] == "degraded"
+    assert health["tenants"]["default"]["supabase"] == "down"
+    # 2 × (diary_days + meals + meal_items)
+    assert health["tenants"]["default"]["pending_writes"] == 6
+
+    come_back(postgrest)
+    assert app.get_failover().replay() > 0
+
+    assert [m["meal_number"] for m in postgrest.rows("meals")] == [1, 2, 3]
+    assert [d["total_kcal"] for d in postgrest.rows("diary_days") if str(d["user_id"]) == "101"] == [900]
+    assert bot.health()["status"] == "ok"
+
+
+def test_replay_is_idempotent_when_response_is_lost(postgrest, bot):
+    add_profile(postgrest, 202)
+    bot(202)
+
+    go_down(postgrest)
+    bot(202)
+    come_back(postgrest)
+
+    # вставка приёма дошла, но ответ потерялся: строки остаются в очереди
+    postgrest.lose_response = "meals"
+    app.get_failover().replay()
+    assert bot.health()["tenants"]["default"]["pending_writes"] > 0
+
+    app.get_failover().mark_up()
+    app.get_failover().replay()
+    assert bot.health()["tenants"]["default"]["pending_writes"] == 0
+
+    meals = [m for m in postgrest.rows("meals") if str(m["user_id"]) == "202"]
+    assert [m["meal_number"] for m in meals] == [1, 2]
+    items = [i for i in postgrest.rows("meal_items") if str(i["user_id"]) == "202"]
+    assert len(items) == 2
+    assert [d["total_kcal"] for d in postgrest.rows("diary_days") if str(d["user_id"]) == "202"] == [600]
+
+
+def test_writes_queue_behind_another_process_backlog(postgrest, bot):
+    add_profile(postgrest, 303)
+    bot(303)
+
+    # очередь, оставленная «другим воркером»: общий файл, свой объект
+    other = app.SupabaseFailover(app.FAILOVER_PATH, app.FAILOVER_SNAPSHOT_PATH)
+    other.enqueue("upsert", "diary_days", {"user_id": 303, "day": app.get_today_key("UTC"), "total_kcal": 300})
+
+    bot(303)
+    # этот процесс не пишет в обход чужой очереди
+    assert len([m for m in postgrest.rows("meals") if str(m["user_id"]) == "303"]) == 1
+
+    app.get_failover().replay()
+    assert [d["total_kcal"] for d in postgrest.rows("diary_days") if str(d["user_id"]) == "303"] == [600]
+
+
+def test_meal_without_snapshot_is_refused_not_misnumbered(postgrest, bot):
+    add_profile(postgrest, 404)
+    # профиль и итог дня прочитаны до сбоя, а приёмов за день ещё не читали — снимка meals нет
+    assert app.get_profile("404")
+    assert app.get_day_total("404", app.get_today_key("UTC")) == 0
+
+    go_down(postgrest)
+    reply = bot(404)
+    assert reply == app.texts("en")["diary_unavailable"]
+    assert bot.health()["tenants"]["default"]["pending_writes"] == 0
+
+    come_back(postgrest)
+    bot(404)
+    bot(404)
+    meals = [m for m in postgrest.rows("meals") if str(m["user_id"]) == "404"]
+    assert [m["meal_number"] for m in meals] == [1, 2]
+    assert [d["total_kcal"] for d in postgrest.rows("diary_days") if str(d["user_id"]) == "404"] == [600]
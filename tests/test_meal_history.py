@@ -0,0 +1,78 @@
+"""
+Локальная история приёмов: порядок выдачи search и порог сходства.
+"""
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def store(tmp_path):
+    return app.MealStore(str(tmp_path / "meals.sqlite3"))
+
+
+def remember(store, user, description, times=1):
+    for _ in range(times):
+        store.remember(user, description, [{"name": description, "kcal": 100}], 100)
+
+
+def similarity(query, description):
+    q = app.trigrams(app.normalize_meal_text(query))
+    d = app.trigrams(app.normalize_meal_text(description))
+    return len(q & d) / len(q)
+
+
+def test_prefix_matches_come_before_fuzzy_ones(store):
+    remember(store, "u", "большая овсянка", times=5)
+    remember(store, "u", "овсянка с бананом")
+    remember(store, "u", "Овсянка с малиной", times=2)
+    assert similarity("овсянка", "большая овсянка") >= app.HISTORY_MIN_SIMILARITY
+
+    found = [m["description"] for m in store.search("u", "Овсянка")]
+    # префиксные — по частоте, нечёткое — после них, даже если его ели чаще
+    assert found == ["Овсянка с малиной", "овсянка с бананом", "большая овсянка"]
+
+
+def test_fuzzy_search_tolerates_typos(store):
+    remember(store, "u", "гречка с курицей")
+    remember(store, "u", "рис с овощами")
+    found = [m["description"] for m in store.search("u", "гречко с курецей")]
+    assert found == ["гречка с курицей"]
+
+
+def test_similarity_threshold(store):
+    remember(store, "u", "творог с мёдом")
+    remember(store, "u", "творожная запеканка")
+    assert similarity("творог", "творожная запеканка") >= app.HISTORY_MIN_SIMILARITY
+    assert similarity("творог с мёдом и орехами", "творог с мёдом") >= app.HISTORY_MIN_SIMILARITY
+    assert similarity("тофу", "творог с мёдом") < app.HISTORY_MIN_SIMILARITY
+
+    assert [m["description"] for m in store.search("u", "творог")] == ["творог с мёдом", "творожная запеканка"]
+    assert [m["description"] for m in store.search("u", "творог с мёдом и орехами")] == ["творог с мёдом"]
+    assert store.search("u", "тофу") == []
+
+
+def test_fuzzy_results_ordered_by_similarity(store):
+    remember(store, "u", "салат из овощей")
+    remember(store, "u", "греческий салат с фетой")
+    query = "салат греческий"
+    assert similarity(query, "греческий салат с фетой") > similarity(query, "салат из овощей")
+    found = [m["description"] for m in store.search("u", query)]
+    assert found[0] == "греческий салат с фетой"
+
+
+def test_search_is_scoped_per_user_and_limited(store):
+    for i in range(15):
+        remember(store, "u", f"омлет {i}")
+    remember(store, "other", "омлет с сыром")
+    found = store.search("u", "омлет", limit=10)
+    assert len(found) == 10
+    assert all(m["description"].startswith("омлет ") for m in found)
+    assert store.search("other", "омлет")[0]["description"] == "омлет с сыром"
+
+
+def test_empty_query_returns_recent(store):
+    remember(store, "u", "рис")
+    remember(store, "u", "паста")
+    assert [m["description"] for m in store.search("u", "  ")] == ["паста", "рис"]
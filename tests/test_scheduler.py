@@ -0,0 +1,152 @@
+"""
+Колесо таймеров, ежедневные задачи по зонам и ключи дня.
+"""
+
+import datetime
+
+import app
+
+
+def ts(text):
+    return datetime.datetime.fromisoformat(text).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def make_wheel(size=10, start=1000):
+    wheel = app.TimerWheel(tick=1.0, size=size)
+    wheel.current = start
+    return wheel
+
+
+def test_wheel_keeps_tasks_beyond_one_revolution():
+    wheel = make_wheel()
+    fired = []
+    # +15 и +5 попадают в один слот колеса из 10
+    wheel.schedule(1015, lambda: fired.append("late"))
+    wheel.schedule(1005, lambda: fired.append("early"))
+
+    assert wheel.advance(1005) == 1
+    assert fired == ["early"]
+    assert wheel.advance(1014) == 0
+    assert wheel.advance(1015) == 1
+    assert fired == ["early", "late"]
+
+
+def test_wheel_reschedule_across_wrap_around():
+    wheel = make_wheel()
+    fired = []
+
+    def every_7():
+        fired.append(wheel.current)
+        wheel.schedule(wheel.current + 7, every_7)
+
+    wheel.schedule(1007, every_7)
+    for now in range(1001, 1030):
+        wheel.advance(now)
+    assert fired == [1007, 1014, 1021, 1028]
+
+
+def test_wheel_catches_up_after_long_pause_in_order():
+    wheel = make_wheel()
+    fired = []
+    for due in (1009, 1003, 1006, 1050):
+        wheel.schedule(due, lambda due=due: fired.append(due))
+
+    # простой на много оборотов: всё просроченное срабатывает один раз, по времени
+    assert wheel.advance(5000) == 4
+    assert fired == [1003, 1006, 1009, 1050]
+    assert wheel.advance(6000) == 0
+
+
+def test_wheel_never_schedules_into_the_past():
+    wheel = make_wheel()
+    fired = []
+    wheel.schedule(10, lambda: fired.append(True))
+    assert wheel.advance(1000) == 0
+    assert wheel.advance(1001) == 1
+
+
+class RecordingWheel:
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, when_ts, callback):
+        self.scheduled.append((when_ts, callback))
+
+    def pop(self):
+        return self.scheduled.pop(0)
+
+
+def test_zone_scheduler_fires_per_zone_and_reschedules_next_day(monkeypatch):
+    monkeypatch.setattr(app.time, "time", lambda: ts("2026-03-10T11:00:00"))
+    wheel = RecordingWheel()
+    scheduler = app.ZoneScheduler(wheel)
+    calls = []
+    scheduler.add_daily_job("summary", 21, 0, lambda tz, day: calls.append((tz, day)))
+    scheduler.add_zone("Asia/Tokyo")
+    scheduler.add_zone("America/Los_Angeles")
+    scheduler.add_zone("Asia/Tokyo")
+
+    assert len(wheel.scheduled) == 2
+    tokyo_when, tokyo_fire = wheel.pop()
+    la_when, la_fire = wheel.pop()
+    assert tokyo_when == ts("2026-03-10T12:00:00")
+    assert la_when == ts("2026-03-11T04:00:00")
+
+    tokyo_fire()
+    la_fire()
+    assert calls == [("Asia/Tokyo", "20260310"), ("America/Los_Angeles", "20260310")]
+    # следующий запуск — через сутки по местному времени
+    assert [when for when, _ in wheel.scheduled] == [ts("2026-03-11T12:00:00"), ts("2026-03-12T04:00:00")]
+
+
+def test_zone_scheduler_follows_dst_change():
+    wheel = RecordingWheel()
+    scheduler = app.ZoneScheduler(wheel)
+    job = ("summary", 21, 0, lambda tz, day: None)
+    # в ночь на 8 марта 2026 Лос-Анджелес переходит с UTC-8 на UTC-7
+    scheduler._schedule("America/Los_Angeles", job, ts("2026-03-07T12:00:00"))
+    scheduler._schedule("America/Los_Angeles", job, ts("2026-03-08T06:00:00"))
+    assert [when for when, _ in wheel.scheduled] == [ts("2026-03-08T05:00:00"), ts("2026-03-09T04:00:00")]
+
+
+def test_day_keys_on_both_sides_of_utc():
+    now = ts("2026-03-10T23:30:00")
+    assert app.tz_day_key("UTC", now) == "20260310"
+    assert app.tz_day_key("Asia/Tokyo", now) == "20260311"
+    assert app.tz_day_key("Pacific/Kiritimati", now) == "20260311"
+    assert app.tz_day_key("America/Los_Angeles", now) == "20260310"
+    assert app.tz_day_key("Pacific/Pago_Pago", now) == "20260310"
+    assert app.tz_day_key("Not/AZone", now) == "20260310"
+
+
+def test_day_key_window_rolls_at_local_midnight():
+    # Токио: местная полночь 11 марта — 15:00 UTC 10 марта
+    assert app.tz_day_key("Asia/Tokyo", ts("2026-03-10T14:59:59")) == "20260310"
+    assert app.tz_day_key("Asia/Tokyo", ts("2026-03-10T15:00:00")) == "20260311"
+    # закэшированное окно не мешает вернуться назад
+    assert app.tz_day_key("Asia/Tokyo", ts("2026-03-10T14:00:00")) == "20260310"
+
+
+def test_day_key_window_is_23_hours_on_dst_day():
+    key = app.tz_day_key("America/Los_Angeles", ts("2026-03-08T12:00:00"))
+    start, end, cached = app._tz_days["America/Los_Angeles"]
+    assert key == cached == "20260308"
+    assert end - start == 23 * 3600
+
+
+def test_forecast_window_does_not_evict_todays_day_key(monkeypatch):
+    now = ts("2026-03-10T12:00:00")
+    monkeypatch.setattr(app.time, "time", lambda: now)
+    monkeypatch.setattr(app, "send_message", lambda chat_id, text, **kwargs: None)
+    queries = []
+    monkeypatch.setattr(app, "supabase_select", lambda table, match, **kwargs: (
+        [{"user_id": "7", "lang": "en", "tz": "Asia/Tokyo", "sex": "m", "weight": 80, "height": 180,
+          "age": 30, "goal": 75, "activity_factor": 1.2}] if table == "profiles" else queries.append(match) or []
+    ))
+    app.tz_day_key("Asia/Tokyo", now)
+    window = app._tz_days["Asia/Tokyo"]
+
+    client = app.app.test_client()
+    assert client.post("/", json={"message": {"chat": {"id": 7}, "text": "/forecast"}}).status_code == 200
+    assert {"day": "gte.20260210"}.items() <= queries[-1].items()
+    assert app._tz_days["Asia/Tokyo"] == window
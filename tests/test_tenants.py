@@ -0,0 +1,43 @@
+"""
+Конфиг арендаторов: у каждого свои данные в Supabase, id уникальны.
+"""
+
+import json
+
+import pytest
+
+import app
+
+
+def load(monkeypatch, tmp_path, configs):
+    path = tmp_path / "tenants.json"
+    path.write_text(json.dumps(configs))
+    monkeypatch.setattr(app, "TENANTS_FILE", str(path))
+    return app.load_tenants()
+
+
+def test_tenant_with_own_schema_or_url(monkeypatch, tmp_path):
+    tenants = load(monkeypatch, tmp_path, [
+        {"id": "fit", "telegram_token": "t1", "supabase_schema": "fit"},
+        {"id": "keto", "telegram_token": "t2", "supabase_url": "https://keto.supabase.co"},
+    ])
+    assert tenants["fit"].supabase_url == app.SUPABASE_URL
+    assert tenants["fit"].supabase_schema == "fit"
+    assert tenants["keto"].supabase_url == "https://keto.supabase.co"
+
+
+@pytest.mark.parametrize("configs", [
+    # данные основного бота
+    [{"id": "fit", "telegram_token": "t1"}],
+    [{"id": "fit", "telegram_token": "t1", "supabase_url": app.SUPABASE_URL}],
+    # id основного бота и повтор id
+    [{"id": "default", "telegram_token": "t1", "supabase_schema": "fit"}],
+    [{"id": "fit", "telegram_token": "t1", "supabase_schema": "fit"},
+     {"id": "fit", "telegram_token": "t2", "supabase_schema": "fit2"}],
+    # два арендатора в одной схеме
+    [{"id": "fit", "telegram_token": "t1", "supabase_schema": "fit"},
+     {"id": "fit2", "telegram_token": "t2", "supabase_schema": "fit"}],
+])
+def test_invalid_tenant_configs_are_rejected(monkeypatch, tmp_path, configs):
+    with pytest.raises(RuntimeError):
+        load(monkeypatch, tmp_path, configs)